@@ -0,0 +1,453 @@
+"""
+Offline benchmark for the bot's download and upload paths.
+
+Starts local stand-ins for api.gofile.io, a Range capable file host and the Bot API, runs the real
+command handlers against them in a fresh bot process per configuration and saves throughput,
+latency, CPU and memory figures as JSON so runs can be compared.
+
+    python benchmark.py --scenarios download,gofile --mixes small,large --workers 2,8
+    python benchmark.py --compare benchmark-results.json --output new-results.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from itertools import product
+from aiohttp import web
+
+BENCH_TOKEN = "123456:benchmark"
+SCENARIOS = ("download", "gofile", "upload", "album")
+KB = 1024
+MB = 1024 * 1024
+
+# File sizes of each mix, every file gets its own content so nothing is deduplicated
+FILE_MIXES = {
+    "small": [64 * KB] * 100,
+    "large": [32 * MB] * 4,
+    "mixed": [64 * KB] * 50 + [4 * MB] * 8 + [16 * MB] * 2,
+}
+
+# Random bytes every stand-in file is cut from, each starting at its own offset
+PATTERN = random.Random(0).randbytes(MB)
+SERVE_CHUNK = 64 * KB
+
+def file_chunks(shift: int, start: int, end: int):
+    """Bytes start..end (exclusive) of the file identified by shift, in chunks of up to SERVE_CHUNK."""
+    position = start
+    while position < end:
+        offset = (position + shift) % len(PATTERN)
+        length = min(SERVE_CHUNK, end - position, len(PATTERN) - offset)
+        yield PATTERN[offset:offset + length]
+        position += length
+
+def file_md5(shift: int, size: int) -> str:
+    digest = hashlib.md5()
+    for chunk in file_chunks(shift, 0, size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def mix_files(mix: str) -> list[tuple[str, int, int]]:
+    """(name, size, shift) of every file in a mix."""
+    return [(f"file{index:04}.bin", size, index * 4099 + 1) for index, size in enumerate(FILE_MIXES[mix])]
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper().removesuffix("B")
+    units = {"K": KB, "M": MB, "G": 1024 * MB}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+# Stand-in servers, run by the parent process
+class StandIns:
+    """File host, GoFile API and Bot API stand-ins on one local port."""
+
+    def __init__(self, latency: float, bandwidth: int) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.base_url = None
+        self.tree = {}
+        self.requests = {}
+        self.uploaded_bytes = 0
+        self._message_id = 0
+        self._runner = None
+
+    def reset(self, mix: str) -> None:
+        """Clear the request log and lay the mix out as a nested GoFile folder tree."""
+        self.requests = {"file": [], "gofile_api": [], "bot_api": []}
+        self.uploaded_bytes = 0
+        folders = {
+            "root": {"type": "folder", "id": "root", "name": "root", "children": {}},
+            "a": {"type": "folder", "id": "a", "name": "a", "children": {}},
+            "b": {"type": "folder", "id": "b", "name": "b", "children": {}},
+            "b1": {"type": "folder", "id": "b1", "name": "b1", "children": {}},
+        }
+        for parent, child in (("root", "a"), ("root", "b"), ("b", "b1")):
+            folders[parent]["children"][child] = {"type": "folder", "id": child, "name": child}
+
+        leaves = ("root", "a", "b1")
+        for index, (name, size, shift) in enumerate(mix_files(mix)):
+            file_id = f"f{index}"
+            folders[leaves[index % len(leaves)]]["children"][file_id] = {
+                "type": "file", "id": file_id, "name": name, "size": size, "md5": file_md5(shift, size),
+                "link": f"{self.base_url}/files/{shift}/{size}/{name}",
+            }
+        self.tree = folders
+
+    def _record(self, kind: str, started: float) -> None:
+        self.requests[kind].append(time.monotonic() - started)
+
+    async def serve_file(self, request: web.Request) -> web.StreamResponse:
+        """Range capable file host with an ETag, a fixed delay before headers and per-connection bandwidth."""
+        started = time.monotonic()
+        shift = int(request.match_info["shift"])
+        size = int(request.match_info["size"])
+        etag = f'"{shift}-{size}"'
+        await asyncio.sleep(self.latency)
+
+        start, end, status = 0, size, 200
+        byte_range = request.headers.get("Range")
+        if byte_range and request.headers.get("If-Range", etag) == etag:
+            first, _, last = byte_range.removeprefix("bytes=").partition("-")
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+            if start >= size:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+
+        headers = {"ETag": etag, "Accept-Ranges": "bytes", "Content-Length": str(end - start)}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+
+        sent = 0
+        sending = time.monotonic()
+        try:
+            for chunk in file_chunks(shift, start, end):
+                await response.write(chunk)
+                sent += len(chunk)
+                if self.bandwidth:
+                    ahead = sent / self.bandwidth - (time.monotonic() - sending)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+            await response.write_eof()
+        except ConnectionResetError:
+            # Probes and finished segments hang up before the body is sent
+            return response
+        self._record("file", started)
+        return response
+
+    async def gofile_accounts(self, request: web.Request) -> web.Response:
+        started = time.monotonic()
+        await asyncio.sleep(self.latency)
+        self._record("gofile_api", started)
+        return web.json_response({"status": "ok", "data": {"token": "benchmark"}})
+
+    async def gofile_contents(self, request: web.Request) -> web.Response:
+        started = time.monotonic()
+        await asyncio.sleep(self.latency)
+        folder = self.tree.get(request.match_info["content_id"])
+        self._record("gofile_api", started)
+        if not folder:
+            return web.json_response({"status": "error-notFound", "data": {}})
+        return web.json_response({"status": "ok", "data": folder})
+
+    def _message(self, chat_id, **fields) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id, "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"}, **fields
+        }
+
+    async def bot_api(self, request: web.Request) -> web.Response:
+        """Enough of the Bot API for the handlers: replies, edits, documents and media groups."""
+        started = time.monotonic()
+        method = request.match_info["method"]
+        form = await request.post()
+        chat_id = form.get("chat_id", 1)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif method == "sendDocument":
+            self.uploaded_bytes += request.content_length or 0
+            result = self._message(chat_id, document={
+                "file_id": f"document{self._message_id}", "file_unique_id": f"unique{self._message_id}"
+            })
+        elif method == "sendMediaGroup":
+            self.uploaded_bytes += request.content_length or 0
+            result = [
+                self._message(chat_id, document={
+                    "file_id": f"document{self._message_id}", "file_unique_id": f"unique{self._message_id}"
+                })
+                for _ in json.loads(form["media"])
+            ]
+        else:
+            result = True
+
+        self._record("bot_api", started)
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=1024 * MB)
+        app.router.add_get("/files/{shift}/{size}/{name}", self.serve_file)
+        app.router.add_post("/gofile/accounts", self.gofile_accounts)
+        app.router.add_get("/gofile/contents/{content_id}", self.gofile_contents)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        self.base_url = f"http://127.0.0.1:{listener.getsockname()[1]}"
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.SockSite(self._runner, listener).start()
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    def summary(self) -> dict:
+        return {
+            f"{kind}_latency": {"count": len(values), "p50": percentile(values, 0.5), "p99": percentile(values, 0.99)}
+            for kind, values in self.requests.items()
+        }
+
+# Bot process, one per configuration
+def command_update(update_id: int, text: str) -> dict:
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Benchmark"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+def directory_size(directory: str) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files if not name.endswith(".part"))
+    return total
+
+async def run_scenario(config: dict) -> dict:
+    """Drive the real handlers through one scenario and measure the bot process."""
+    import bot
+    from telegram import Update
+
+    # The bot logs every request at INFO, which would dominate small-file runs
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    base_url = config["base_url"]
+    files = mix_files(config["mix"])
+    if config["scenario"] == "download":
+        commands = [f"/download {base_url}/files/{shift}/{size}/{name}" for name, size, shift in files]
+    elif config["scenario"] == "gofile":
+        commands = ["/gofile https://gofile.io/d/root"]
+    else:
+        source = tempfile.mkdtemp(prefix="upload-", dir=config["work_dir"])
+        for name, size, shift in files:
+            with open(os.path.join(source, name), "wb") as handler:
+                for chunk in file_chunks(shift, 0, size):
+                    handler.write(chunk)
+        flags = " --album" if config["scenario"] == "album" else ""
+        commands = [f"/upload{flags} {source}"]
+
+    application = bot.build_application(token=BENCH_TOKEN, base_url=f"{base_url}/bot")
+    await application.initialize()
+    # Starts the worker processes when WORKER_PROCESSES is set, their start up isn't part of the run
+    await application.post_init(application)
+    while bot.workers.active and bot.workers.connected < bot.WORKER_PROCESSES:
+        await asyncio.sleep(0.05)
+
+    async def run_command(update_id: int, text: str) -> float:
+        started = time.monotonic()
+        await application.process_update(Update.de_json(command_update(update_id, text), application.bot))
+        return time.monotonic() - started
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    latencies = await asyncio.gather(*(run_command(index, text) for index, text in enumerate(commands, start=1)))
+    wall = time.monotonic() - started
+    finished = resource.getrusage(resource.RUSAGE_SELF)
+
+    await application.shutdown()
+    await application.post_shutdown(application)
+    # Worker processes, reaped by the shutdown above
+    workers_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    payload = sum(size for _, size, _ in files)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = finished.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    result = {
+        "bytes": payload,
+        "jobs": len(commands),
+        "wall_seconds": wall,
+        "throughput_bytes_per_second": payload / wall if wall else None,
+        "job_latency": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99)},
+        "cpu_seconds": (finished.ru_utime - usage.ru_utime) + (finished.ru_stime - usage.ru_stime)
+                       + workers_cpu.ru_utime + workers_cpu.ru_stime,
+        "peak_rss_bytes": peak_rss,
+    }
+    if config["scenario"] in ("download", "gofile"):
+        result["complete"] = directory_size(config["output_dir"]) == payload
+    return result
+
+def worker_main(config_path: str) -> None:
+    with open(config_path) as handler:
+        config = json.load(handler)
+    result = asyncio.run(run_scenario(config))
+    with open(config["result_file"], "w") as handler:
+        json.dump(result, handler)
+
+# Orchestration
+async def run_configuration(standins: StandIns, scenario: str, mix: str, chunk_size: int, workers: int,
+                            extra_env: dict) -> dict:
+    """Run one configuration in a fresh bot process, so CPU and memory figures are its own."""
+    standins.reset(mix)
+    with tempfile.TemporaryDirectory(prefix="bot-benchmark-") as work_dir:
+        config = {
+            "scenario": scenario, "mix": mix, "base_url": standins.base_url, "work_dir": work_dir,
+            "output_dir": os.path.join(work_dir, "output"), "result_file": os.path.join(work_dir, "result.json"),
+        }
+        os.makedirs(config["output_dir"])
+        config_path = os.path.join(work_dir, "config.json")
+        with open(config_path, "w") as handler:
+            json.dump(config, handler)
+
+        env = {
+            **os.environ,
+            "TELEGRAM_TOKEN": BENCH_TOKEN,
+            "BASE_URL": f"{standins.base_url}/bot",
+            "GOFILE_API_URL": f"{standins.base_url}/gofile",
+            "OUTPUT_DIR": config["output_dir"],
+            "STATE_DIR": os.path.join(work_dir, "state"),
+            "METRICS_PORT": "0",
+            "HTTP_CHUNK_SIZE": str(chunk_size),
+            "SEGMENT_COUNT": str(workers),
+            "MAX_FILE_WORKERS": str(workers),
+            "UPLOAD_CONCURRENCY": str(workers),
+            **extra_env,
+        }
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--worker", config_path,
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, errors = await process.communicate()
+        if process.returncode != 0 or not os.path.exists(config["result_file"]):
+            raise RuntimeError(f"{scenario}/{mix} run failed:\n{errors.decode(errors='replace')[-4000:]}")
+
+        with open(config["result_file"]) as handler:
+            result = json.load(handler)
+
+    if scenario in ("upload", "album"):
+        # Multipart overhead makes the received body a little larger than the files
+        result["complete"] = standins.uploaded_bytes >= result["bytes"]
+    return {"scenario": scenario, "mix": mix, "chunk_size": chunk_size, "workers": workers, **result, **standins.summary()}
+
+def result_key(result: dict) -> tuple:
+    return result["scenario"], result["mix"], result["chunk_size"], result["workers"]
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Throughput changes against baseline; returns the configurations that regressed past threshold."""
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(result_key(result))
+        if not old or not old["throughput_bytes_per_second"]:
+            continue
+        change = result["throughput_bytes_per_second"] / old["throughput_bytes_per_second"] - 1
+        label = "{}/{} chunk={} workers={}".format(*result_key(result))
+        print(f"{label}: {change:+.1%} throughput")
+        if change < -threshold:
+            regressions.append(label)
+    return regressions
+
+async def run_benchmarks(args: argparse.Namespace) -> dict:
+    standins = StandIns(args.latency, parse_size(args.bandwidth) if args.bandwidth else 0)
+    await standins.start()
+    results = []
+    try:
+        for scenario, mix, chunk_size, workers in product(args.scenarios, args.mixes, args.chunk_sizes, args.workers):
+            result = await run_configuration(standins, scenario, mix, chunk_size, workers, args.env)
+            results.append(result)
+            print(
+                f"{scenario:8} {mix:6} chunk={chunk_size:<8} workers={workers:<3} "
+                f"{result['throughput_bytes_per_second'] / MB:8.1f} MiB/s  "
+                f"cpu={result['cpu_seconds']:.2f}s  rss={result['peak_rss_bytes'] / MB:.0f} MiB"
+                f"{'' if result['complete'] else '  INCOMPLETE'}"
+            )
+    finally:
+        await standins.stop()
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "settings": {"latency": args.latency, "bandwidth": args.bandwidth, "env": args.env},
+        "results": results,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local stand-in servers.")
+    parser.add_argument("--scenarios", default="download,gofile,upload",
+                        help=f"Comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--mixes", default="small,large,mixed", help=f"Comma separated, from {', '.join(FILE_MIXES)}")
+    parser.add_argument("--chunk-sizes", default="1M", help="HTTP_CHUNK_SIZE values, the largest read size for downloads")
+    parser.add_argument("--workers", default="4",
+                        help="Values for SEGMENT_COUNT, MAX_FILE_WORKERS and UPLOAD_CONCURRENCY together")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds every stand-in waits before answering")
+    parser.add_argument("--bandwidth", default="", help="Per-connection file host bandwidth, e.g. 20M (default unlimited)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the bot, may be repeated")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="Results file to compare throughput against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Throughput drop counted as a regression")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker_main(args.worker)
+        return
+
+    args.scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    args.mixes = [mix for mix in args.mixes.split(",") if mix]
+    unknown = (set(args.scenarios) - set(SCENARIOS)) | (set(args.mixes) - set(FILE_MIXES))
+    if unknown:
+        parser.error(f"Unknown scenario or mix: {', '.join(sorted(unknown))}")
+    args.chunk_sizes = [parse_size(size) for size in args.chunk_sizes.split(",")]
+    args.workers = [int(workers) for workers in args.workers.split(",")]
+    args.env = dict(item.split("=", 1) for item in args.env)
+
+    report = asyncio.run(run_benchmarks(args))
+    with open(args.output, "w") as handler:
+        json.dump(report, handler, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as handler:
+            regressions = compare(json.load(handler), report, args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,54 @@
+import json
 import logging
 import os
 import requests
+import aiohttp
 import asyncio
+import ctypes
+import errno
+import heapq
+import hmac
+import io
+import itertools
+import multiprocessing
+import queue
+import signal
+import sqlite3
+import tarfile
 import time
+import zipfile
+from aiohttp import web
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import ExitStack, aclosing
+from fnmatch import fnmatch
+from functools import partial
 from pathlib import Path
-from shutil import move
-from telegram import Update
+from shutil import copyfileobj, disk_usage, move, rmtree
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.request import HTTPXRequest
 import humanize
+from cachetools import TTLCache
 from dotenv import load_dotenv
 # Import necessary libraries for GoFile downloader
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+from threading import Condition, Event, Lock, Thread, active_count
+from weakref import WeakSet, WeakValueDictionary
+from urllib.parse import urlparse
 from platform import system
-from hashlib import sha256
-from sys import exit, stdout, stderr
+from hashlib import md5, sha256
+from sys import argv, executable, exit, stdout, stderr
+
+# Optional: zstd compressed tar archives can only be extracted with it installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 load_dotenv()
 
@@ -30,13 +64,148 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8081/bot")
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "/DATA/Media/")
 UPDATE_INTERVAL = 3
+# Where files stored by the local Bot API server appear on this machine, e.g. /var/lib/telegram-bot-api=/srv/bot-api
+BOT_API_PATH_MAP = os.getenv("BOT_API_PATH_MAP", "")
+STATE_DIR = os.getenv("STATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "state"))
+CONTENT_INDEX_DB = os.path.join(STATE_DIR, "index.db")
+JOURNAL_DB = os.path.join(STATE_DIR, "journal.db")
+UPLOAD_CACHE_DB = os.path.join(STATE_DIR, "uploads.db")
+UPLOAD_CACHE_SIZE = int(os.getenv("UPLOAD_CACHE_SIZE", 100000))
+UPLOAD_CACHE_HASH = os.getenv("UPLOAD_CACHE_HASH", "false").lower() in ("1", "true", "yes")
+JOURNAL_CHECKPOINT_INTERVAL = 1.0
+HASH_CHUNK_SIZE = 1024 * 1024
+# Processes that checksum files already on disk, so re-running a large GoFile share is fast
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+VERIFY_ATTEMPTS = 3
+
+# Async HTTP download engine configuration
+HTTP_CHUNK_SIZE = int(os.getenv("HTTP_CHUNK_SIZE", 1024 * 1024))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", 10))
+
+# Segmented (HTTP Range) download configuration
+SEGMENT_COUNT = int(os.getenv("SEGMENT_COUNT", 4))
+SEGMENT_MIN_SIZE = int(os.getenv("SEGMENT_MIN_SIZE", 8 * 1024 * 1024))
+SEGMENT_SPLIT_MIN = 1024 * 1024
+SEGMENT_RETRIES = 3
+
+# A /download interrupted by the network continues from its .part this many times before the job fails
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_BACKOFF = 2.0
+
+# Disk write path: reads grow from WRITE_CHUNK_MIN up to HTTP_CHUNK_SIZE as throughput allows
+WRITE_CHUNK_MIN = 64 * 1024
+WRITE_CHUNK_SECONDS = 0.1
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", 8))
+# none, close (before a finished download is renamed into place) or interval (also every FSYNC_INTERVAL bytes)
+FSYNC_POLICIES = ("none", "close", "interval")
+FSYNC_POLICY = os.getenv("FSYNC_POLICY", "none").lower()
+FSYNC_INTERVAL = int(os.getenv("FSYNC_INTERVAL", 64 * 1024 * 1024))
+
+# Output volumes: downloads into one of OUTPUT_VOLUMES (OUTPUT_DIR defaults to the first) are spread over all
+# of them by free space and measured write speed. A download of known size only starts where it fits with
+# FREE_SPACE_MARGIN bytes to spare
+OUTPUT_VOLUMES = [path.strip() for path in os.getenv("OUTPUT_VOLUMES", "").split(",") if path.strip()]
+FREE_SPACE_MARGIN = int(os.getenv("FREE_SPACE_MARGIN", 1024 * 1024 * 1024))
+if OUTPUT_VOLUMES and not os.getenv("OUTPUT_DIR"):
+    OUTPUT_DIR = OUTPUT_VOLUMES[0]
+
+# Download job scheduler configuration
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", 4))
+MAX_JOBS_PER_HOST = int(os.getenv("MAX_JOBS_PER_HOST", 2))
+MAX_JOBS_PER_CHAT = int(os.getenv("MAX_JOBS_PER_CHAT", 2))
+MAX_FILE_WORKERS = int(os.getenv("MAX_FILE_WORKERS", 8))
+MAX_SEGMENT_WORKERS = int(os.getenv("MAX_SEGMENT_WORKERS", 16))
+MAX_CRAWL_WORKERS = int(os.getenv("MAX_CRAWL_WORKERS", 8))
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Worker processes: downloads run in WORKER_PROCESSES processes of their own, 0 keeps them in the bot process
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0))
+BROKER_SOCKET = os.getenv("BROKER_SOCKET", os.path.join(STATE_DIR, "broker.sock"))
+WORKER_CONNECT_TIMEOUT = 30
+WORKER_RETRIES = 1
 
-# Track processed files and upload states
-processed_files = set()
+# Upload pipeline configuration
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 3))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", 5))
+UPLOAD_BACKOFF = 2.0
+UPLOAD_PROGRESS_INTERVAL = 5
+SCAN_QUEUE_SIZE = 1000
+
+# Album (sendMediaGroup) upload configuration
+ALBUM_SIZE = 10
+ALBUM_MAX_BYTES = int(os.getenv("ALBUM_MAX_BYTES", 50 * 1024 * 1024))
+ALBUM_PHOTO_MAX = 10 * 1024 * 1024
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+VIDEO_EXTENSIONS = {".mp4", ".m4v", ".mov"}
+AUDIO_EXTENSIONS = {".mp3", ".m4a"}
+# Photos and videos can share an album, audio and documents only go with their own kind
+ALBUM_GROUPS = {"photo": "visual", "video": "visual", "audio": "audio", "document": "document"}
+ALBUM_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "audio": InputMediaAudio, "document": InputMediaDocument}
+
+# Bandwidth limits ("10M", "512K", 0 for unlimited) and time-of-day schedules ("08:00-18:00=5M,...")
+DOWNLOAD_LIMIT = os.getenv("DOWNLOAD_LIMIT", "0")
+DOWNLOAD_LIMIT_PER_CHAT = os.getenv("DOWNLOAD_LIMIT_PER_CHAT", "0")
+DOWNLOAD_LIMIT_PER_JOB = os.getenv("DOWNLOAD_LIMIT_PER_JOB", "0")
+DOWNLOAD_SCHEDULE = os.getenv("DOWNLOAD_SCHEDULE", "")
+UPLOAD_LIMIT = os.getenv("UPLOAD_LIMIT", "0")
+UPLOAD_LIMIT_PER_CHAT = os.getenv("UPLOAD_LIMIT_PER_CHAT", "0")
+UPLOAD_LIMIT_PER_JOB = os.getenv("UPLOAD_LIMIT_PER_JOB", "0")
+UPLOAD_SCHEDULE = os.getenv("UPLOAD_SCHEDULE", "")
+
+# Prometheus metrics endpoint, METRICS_PORT=0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
+# Seconds between the free space checks the volume gauge reports, which walk unfinished extractions
+VOLUME_REFRESH_INTERVAL = 15
+
+# Webhook delivery, used instead of polling when WEBHOOK_URL is set. The Bot API server posts updates to
+# WEBHOOK_URL, which must reach the listener on WEBHOOK_HOST:WEBHOOK_PORT (directly or through a proxy)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# /download with many URLs: at most BATCH_CONCURRENCY of them are handed to the scheduler at once, and one
+# status message is edited every BATCH_STATUS_INTERVAL seconds with the first BATCH_STATUS_LINES of them
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_STATUS_INTERVAL = 5
+BATCH_STATUS_LINES = 15
+URL_LIST_MAX_BYTES = 1024 * 1024
+
+# Status message edits all go through one scheduler: a chat gets at most one every STATUS_CHAT_INTERVAL seconds,
+# the bot at most STATUS_EDITS_PER_SECOND, and a chat with STATUS_BATCH_THRESHOLD or more jobs reporting
+# progress gets one combined message instead of an edit per job
+STATUS_CHAT_INTERVAL = float(os.getenv("STATUS_CHAT_INTERVAL", 3))
+STATUS_EDITS_PER_SECOND = float(os.getenv("STATUS_EDITS_PER_SECOND", 20))
+STATUS_BATCH_THRESHOLD = int(os.getenv("STATUS_BATCH_THRESHOLD", 3))
+STATUS_IDLE_TTL = 3600
+MESSAGE_TEXT_LIMIT = 4096
+
+# Track upload states
 upload_states = {}
 
+# Shared thread pools, sized once for the whole bot instead of per command
+_job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="job")
+_file_executor = ThreadPoolExecutor(max_workers=MAX_FILE_WORKERS, thread_name_prefix="file")
+_segment_executor = ThreadPoolExecutor(max_workers=MAX_SEGMENT_WORKERS, thread_name_prefix="segment")
+_crawl_executor = ThreadPoolExecutor(max_workers=MAX_CRAWL_WORKERS, thread_name_prefix="crawl")
+
 # GoFile downloader constants
 NEW_LINE = "\n" if system() != "Windows" else "\r\n"
+GOFILE_API_URL = os.getenv("GOFILE_API_URL", "https://api.gofile.io")
+GOFILE_CRAWL_FANOUT = int(os.getenv("GOFILE_CRAWL_FANOUT", 4))
+GOFILE_PROGRESS_INTERVAL = 5
+GOFILE_LISTING_TTL = int(os.getenv("GOFILE_LISTING_TTL", 300))
+GOFILE_TOKEN_TTL = int(os.getenv("GOFILE_TOKEN_TTL", 7 * 24 * 3600))
+GOFILE_TOKEN_CACHE = os.path.join(STATE_DIR, "gofile_token.json")
+
+# Recently fetched GoFile folder listings, shared by all jobs
+_listing_cache = TTLCache(maxsize=1024, ttl=GOFILE_LISTING_TTL)
+_listing_cache_lock = Lock()
 
 class UploadState:
     def __init__(self):
@@ -55,315 +224,3507 @@ def die(msg: str):
     _print(f"{msg}{NEW_LINE}", True)
     exit(-1)
 
-# GoFile downloader class
-class GoFileDownloader:
-    def __init__(self, url: str, password: str | None = None, max_workers: int = 5, output_dir: str = None) -> None:
-        self._root_dir = output_dir if output_dir else os.getcwd()
+# Metrics
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter:
+    """Prometheus style counter whose samples are keyed by label values."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
         self._lock = Lock()
-        self._max_workers = max_workers
-        token = os.getenv("GF_TOKEN")
-        self._message = " "
-        self._content_dir = None
-        self._files_info = {}
-        self._token = token if token else self._get_token()
-        self._download_progress = {}
-        
-    def _threaded_downloads(self) -> None:
-        """Parallelize the downloads."""
-        if not self._content_dir:
-            _print(f"Content directory wasn't created, nothing done.{NEW_LINE}")
-            return
+        metrics.register(self)
 
-        os.chdir(self._content_dir)
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
 
-        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
-            for item in self._files_info.values():
-                executor.submit(self._download_content, item)
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
 
-        os.chdir(self._root_dir)
+    def total(self, **labels) -> float:
+        """Sum of the samples whose labels have the given values."""
+        wanted = {self.labels.index(label): str(value) for label, value in labels.items()}
+        with self._lock:
+            return sum(
+                value for key, value in self._values.items()
+                if all(key[index] == expected for index, expected in wanted.items())
+            )
 
-    def _create_dir(self, dirname: str) -> None:
-        """Creates a directory where the files will be saved if it doesn't exist."""
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+class Gauge(Counter):
+    """Gauge read from a callback at scrape time, returning (labels, value) pairs."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect) -> None:
+        super().__init__(name, documentation)
+        self._collect = collect
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        return [(self.name, labels, value) for labels, value in self._collect()]
+
+class Histogram(Counter):
+    """Prometheus style histogram with fixed buckets."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def summary(self) -> tuple[int, float, float | None]:
+        """Observation count, mean and the bucket bound under which 95% fall (None past the last bucket)."""
+        with self._lock:
+            counts = [sum(column) for column in zip(*(counts for counts, _ in self._values.values()))]
+            total = sum(total for _, total in self._values.values())
+        count = sum(counts)
+        if not count:
+            return 0, 0.0, None
+
+        seen = 0
+        for bound, bucket_count in zip((*self.buckets, None), counts):
+            seen += bucket_count
+            if seen >= 0.95 * count:
+                return count, total / count, bound
+        return count, total / count, None
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics = []
+        self.started = time.time()
+
+    def register(self, metric: Counter) -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                rendered = ",".join(
+                    f'{label}="{str(label_value).translate(LABEL_ESCAPES)}"' for label, label_value in labels.items()
+                )
+                lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+metrics = MetricsRegistry()
+
+transferred_bytes = Counter("bot_transferred_bytes_total", "Bytes downloaded or uploaded", ("direction", "host"))
+time_to_first_byte = Histogram("bot_download_ttfb_seconds", "Time from sending a download request to its response headers", ("host",))
+gofile_api_latency = Histogram("bot_gofile_api_seconds", "GoFile API request latency", ("endpoint",))
+telegram_api_latency = Histogram("bot_telegram_api_seconds", "Bot API request latency", ("method",))
+telegram_flood_waits = Counter("bot_telegram_flood_waits_total", "Bot API requests answered with 429 Too Many Requests", ("method",))
+Gauge("bot_jobs", "Download jobs by state", lambda: [({"state": state}, len(jobs)) for state, jobs in zip(("running", "queued"), scheduler.snapshot())])
+Gauge("bot_threads", "Live Python threads", lambda: [({}, active_count())])
+Gauge(
+    "bot_volume_free_bytes", "Space left for new downloads on each output volume, after reservations and the margin",
+    lambda: [({"volume": directory}, free) for directory, free, _ in volumes.last_status()]
+)
+
+def job_speeds() -> list[tuple[dict, float]]:
+    """Summed average speed of the running jobs per direction and host; URLs would make a new series per job."""
+    speeds = defaultdict(float)
+    for shaper in (download_shaper, upload_shaper):
+        for throttle in shaper.throttles():
+            speeds[shaper.direction, throttle.host] += throttle.speed()
+    return [({"direction": direction, "host": host}, speed) for (direction, host), speed in speeds.items()]
+
+Gauge("bot_job_bytes_per_second", "Combined average speed of the running jobs on each host", job_speeds)
+
+class MeteredRequest(HTTPXRequest):
+    """Bot API client that records the latency of every call and counts flood waits."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.monotonic()
         try:
-            os.mkdir(dirname)
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        finally:
+            telegram_api_latency.observe(time.monotonic() - started, method=api_method)
+        if code == 429:
+            telegram_flood_waits.inc(method=api_method)
+        return code, payload
+
+_metrics_runner = None
+_volume_refresher = None
+
+async def refresh_volumes() -> None:
+    """Recheck the output volumes' free space every VOLUME_REFRESH_INTERVAL, off the event loop."""
+    while True:
+        await asyncio.to_thread(volumes.status, volumes.roots or [OUTPUT_DIR])
+        await asyncio.sleep(VOLUME_REFRESH_INTERVAL)
+
+async def start_metrics_server() -> None:
+    """Serve /metrics on METRICS_HOST:METRICS_PORT for Prometheus, unless METRICS_PORT is 0."""
+    global _metrics_runner, _volume_refresher
+    if not METRICS_PORT:
+        return
+
+    async def serve_metrics(request: web.Request) -> web.Response:
+        # Rendering walks every series, so it stays off the loop the bot's handlers run on
+        text = await asyncio.to_thread(metrics.render)
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.warning(f"Couldn't start the metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return
+    _metrics_runner = runner
+    # The volume gauge reports these figures, a scrape never walks the disk itself
+    _volume_refresher = asyncio.create_task(refresh_volumes())
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server() -> None:
+    global _metrics_runner, _volume_refresher
+    if _volume_refresher is not None:
+        _volume_refresher.cancel()
+        _volume_refresher = None
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+# Pooled HTTP sessions for the threaded (requests based) downloaders
+_requests_session = None
+_requests_session_lock = Lock()
+
+def get_requests_session() -> requests.Session:
+    """Return the shared keep-alive session used by every blocking HTTP call."""
+    global _requests_session
+    with _requests_session_lock:
+        if _requests_session is None:
+            session = requests.Session()
+            # Accounts are passed explicitly per request, never keep cookies between jobs
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+            # Every file worker and segment may hold a connection to the same host
+            file_adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE,
+                pool_maxsize=max(HTTP_POOL_PER_HOST, MAX_FILE_WORKERS + MAX_SEGMENT_WORKERS)
+            )
+            session.mount("http://", file_adapter)
+            session.mount("https://", file_adapter)
+
+            # API calls come from the crawl pool only
+            session.mount(f"{GOFILE_API_URL}/", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CRAWL_WORKERS))
+
+            _requests_session = session
+        return _requests_session
+
+# GoFile account token cache
+_gofile_token_lock = Lock()
+
+def _create_gofile_account() -> str:
+    """Create a guest GoFile account and return its token."""
+    user_agent = os.getenv("GF_USERAGENT")
+    headers = {
+        "User-Agent": user_agent if user_agent else "Mozilla/5.0",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Accept": "*/*",
+        "Connection": "keep-alive",
+    }
+
+    started = time.monotonic()
+    create_account_response = get_requests_session().post(
+        f"{GOFILE_API_URL}/accounts", headers=headers, timeout=(9, 27)
+    ).json()
+    gofile_api_latency.observe(time.monotonic() - started, endpoint="accounts")
+
+    if create_account_response["status"] != "ok":
+        raise RuntimeError("GoFile account creation failed!")
+
+    return create_account_response["data"]["token"]
+
+def get_gofile_token(refresh: bool = False) -> str:
+    """Return the cached GoFile account token, creating a new account when missing, expired or refreshed."""
+    with _gofile_token_lock:
+        if not refresh:
+            try:
+                with open(GOFILE_TOKEN_CACHE) as handler:
+                    cached = json.load(handler)
+                if time.time() - cached["created"] < GOFILE_TOKEN_TTL:
+                    return cached["token"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        token = _create_gofile_account()
+
+        try:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            tmp_file = f"{GOFILE_TOKEN_CACHE}.tmp"
+            with open(tmp_file, "w") as handler:
+                json.dump({"token": token, "created": time.time()}, handler)
+            os.replace(tmp_file, GOFILE_TOKEN_CACHE)
+        except OSError as e:
+            logger.warning(f"Couldn't save GoFile token cache: {e}")
+
+        return token
+
+# SQLite backed state
+class SqliteStore:
+    """Lazily opened SQLite database shared by the bot's threads, guarded by one lock."""
+    SCHEMA = ""
+
+    def __init__(self, db_path: str) -> None:
+        self._db_path = db_path
+        self._db = None
+        self._lock = Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+            # Worker processes share the databases, so wait out their writes instead of failing
+            self._db = sqlite3.connect(self._db_path, check_same_thread=False, timeout=30)
+            self._db.row_factory = sqlite3.Row
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+# Content-addressed download index
+class ContentIndex(SqliteStore):
+    """SQLite index of downloaded files keyed by their sha256, used to hardlink duplicates."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS content (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            file_unique_id TEXT PRIMARY KEY,
+            hash TEXT NOT NULL
+        );
+    """
+
+    def find(self, digest: str) -> str | None:
+        """Path of a still intact file with this hash, if any."""
+        with self._lock:
+            row = self._connect().execute("SELECT path, size FROM content WHERE hash = ?", (digest,)).fetchone()
+            if not row:
+                return None
+
+            path, size = row["path"], row["size"]
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                return path
+
+            # The indexed copy was deleted or changed on disk
+            self._db.execute("DELETE FROM content WHERE hash = ?", (digest,))
+            self._db.commit()
+            return None
+
+    def add(self, digest: str, path: str) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO content (hash, path, size) VALUES (?, ?, ?)",
+                (digest, path, os.path.getsize(path))
+            )
+            self._db.commit()
+
+    def find_telegram(self, file_unique_id: str) -> str | None:
+        """Path of a previously received Telegram file, if it is still on disk."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT hash FROM telegram_files WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+        return self.find(row["hash"]) if row else None
+
+    def add_telegram(self, file_unique_id: str, digest: str) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO telegram_files (file_unique_id, hash) VALUES (?, ?)",
+                (file_unique_id, digest)
+            )
+            self._db.commit()
+
+    def store(self, path: str, digest: str) -> str:
+        """Index a finished download, replacing it with a hardlink when the content is already stored."""
+        existing = self.find(digest)
+
+        if not existing or os.path.samefile(existing, path):
+            self.add(digest, path)
+            return path
+
+        try:
+            link_file(existing, path)
+            logger.info(f"{path} duplicates {existing}, replaced with a hardlink")
+        except OSError as e:
+            # Different filesystem or no hardlink support, keep the copy
+            logger.warning(f"Couldn't hardlink {path} to {existing}: {e}")
+
+        return path
+
+content_index = ContentIndex(CONTENT_INDEX_DB)
+
+def link_file(source: str, destination: str) -> None:
+    """Atomically make destination a hardlink of source."""
+    tmp_file = f"{destination}.link"
+    os.link(source, tmp_file)
+    os.replace(tmp_file, destination)
+
+def hash_file(path: str, *digests) -> str:
+    """sha256 of a file on disk, or else feed it to digests in one read and return the first one's hex."""
+    digests = digests if digests else (sha256(),)
+    with open(path, "rb") as handler:
+        while chunk := handler.read(HASH_CHUNK_SIZE):
+            for digest in digests:
+                digest.update(chunk)
+    return digests[0].hexdigest()
+
+def _file_checksums(path: str) -> tuple[str, str]:
+    md5_digest = md5()
+    digest = hash_file(path, sha256(), md5_digest)
+    return md5_digest.hexdigest(), digest
+
+_checksum_executor = None
+_checksum_executor_lock = Lock()
+
+def checksum_file(path: str) -> tuple[str, str]:
+    """(md5, sha256) of a file on disk, hashed in a worker process so several files are checked in parallel."""
+    global _checksum_executor
+    with _checksum_executor_lock:
+        if _checksum_executor is None:
+            # Not forked from this process, whose other threads could be holding a lock at that moment
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _checksum_executor = ProcessPoolExecutor(HASH_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _checksum_executor.submit(_file_checksums, path).result()
+
+def reserve_filepath(directory: str, filename: str) -> str:
+    """Create an empty file named filename (or filename(n)) in directory so nothing gets overwritten."""
+    root, extension = os.path.splitext(filename)
+    candidate = filename
+    for count in itertools.count(1):
+        filepath = os.path.join(directory, candidate)
+        try:
+            with open(filepath, "xb"):
+                return filepath
         except FileExistsError:
-            pass
+            candidate = f"{root}({count}){extension}"
 
-    @staticmethod
-    def _get_token() -> str:
-        """Gets the access token of account created."""
-        user_agent = os.getenv("GF_USERAGENT")
-        headers = {
-            "User-Agent": user_agent if user_agent else "Mozilla/5.0",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept": "*/*",
-            "Connection": "keep-alive",
-        }
+# Local Bot API file ingestion
+FICLONE = 0x40049409
 
-        create_account_response = requests.post("https://api.gofile.io/accounts", headers=headers).json()
+def parse_path_map(value: str) -> list[tuple[str, str]]:
+    """Parse "server_prefix=local_prefix,..." into pairs, longest server prefix first."""
+    pairs = []
+    for item in value.split(","):
+        remote, separator, local = item.partition("=")
+        if separator and remote.strip() and local.strip():
+            pairs.append((remote.strip().rstrip("/"), local.strip().rstrip("/")))
+    return sorted(pairs, key=lambda pair: len(pair[0]), reverse=True)
 
-        if create_account_response["status"] != "ok":
-            die("Account creation failed!")
+BOT_API_PATHS = parse_path_map(BOT_API_PATH_MAP)
 
-        return create_account_response["data"]["token"]
+def local_bot_api_path(file_path: str) -> str | None:
+    """
+    Where a file the local Bot API server stored at file_path can be read on this machine, if anywhere.
+    Blocking, so call it off the event loop.
+    """
+    if file_path.startswith(("http://", "https://")):
+        return None
 
-    def _download_content(self, file_info: dict[str, str], chunk_size: int = 16384) -> None:
-        """Requests the contents of the file and writes it."""
-        filepath = os.path.join(file_info["path"], file_info["filename"])
-        if os.path.exists(filepath):
-            if os.path.getsize(filepath) > 0:
-                _print(f"{filepath} already exist, skipping.{NEW_LINE}")
-                return
+    # An empty base_file_url leaves the server's absolute path behind extra slashes
+    server_path = "/" + file_path.lstrip("/")
+    local_path = server_path
+    for remote, local in BOT_API_PATHS:
+        if server_path == remote or server_path.startswith(remote + "/"):
+            local_path = local + server_path[len(remote):]
+            break
 
-        tmp_file = f"{filepath}.part"
-        url = file_info["link"]
-        user_agent = os.getenv("GF_USERAGENT")
+    # Unmapped paths only work when the server shares this filesystem layout
+    return local_path if os.path.isfile(local_path) else None
 
-        headers = {
-            "Cookie": f"accountToken={self._token}",
-            "Accept-Encoding": "gzip, deflate, br",
-            "User-Agent": user_agent if user_agent else "Mozilla/5.0",
-            "Accept": "*/*",
-            "Referer": f"{url}{('/' if not url.endswith('/') else '')}",
-            "Origin": url,
-            "Connection": "keep-alive",
-            "Sec-Fetch-Dest": "empty",
-            "Sec-Fetch-Mode": "cors",
-            "Sec-Fetch-Site": "same-site",
-            "Pragma": "no-cache",
-            "Cache-Control": "no-cache"
-        }
+def _copy_in_kernel(source: str, destination: str) -> None:
+    """
+    Copy without passing the data through userspace, via copy_file_range or else sendfile.
+    Raises OSError when neither moves the whole file, so the caller can fall back to a plain copy.
+    """
+    with open(source, "rb") as reader, open(destination, "wb") as writer:
+        size = os.fstat(reader.fileno()).st_size
+        try:
+            remaining = size
+            while remaining > 0:
+                copied = os.copy_file_range(reader.fileno(), writer.fileno(), remaining)
+                if not copied:
+                    # Some filesystems report 0 instead of an error when they can't copy between them
+                    if remaining == size:
+                        raise OSError(errno.EXDEV, "copy_file_range copied nothing")
+                    break
+                remaining -= copied
+        except (AttributeError, OSError):
+            # Not supported between these filesystems, start over with sendfile
+            reader.seek(0)
+            writer.seek(0)
+            writer.truncate()
 
-        # Check for partial download and resume from last byte
-        part_size = 0
-        if os.path.isfile(tmp_file):
-            part_size = int(os.path.getsize(tmp_file))
-            headers["Range"] = f"bytes={part_size}-"
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(writer.fileno(), reader.fileno(), offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
 
-        has_size = None
-        status_code = None
+        copied = os.fstat(writer.fileno()).st_size
+        if copied != size:
+            raise OSError(errno.EIO, f"copied {copied} of {size} bytes")
+
+def _reflink(source: str, destination: str) -> None:
+    from fcntl import ioctl
+    with open(source, "rb") as reader, open(destination, "wb") as writer:
+        ioctl(writer.fileno(), FICLONE, reader.fileno())
+
+def _copy(source: str, destination: str) -> None:
+    with open(source, "rb") as reader, open(destination, "wb") as writer:
+        copyfileobj(reader, writer, HASH_CHUNK_SIZE)
 
+def ingest_file(source: str, destination: str) -> str:
+    """
+    Take over a file the Bot API server saved, using the cheapest method the filesystems allow.
+    Blocking, so call it off the event loop. Returns the method that worked.
+    """
+    try:
+        os.replace(source, destination)
+        return "rename"
+    except OSError as e:
+        logger.debug(f"Couldn't rename {source} to {destination}: {e}")
+
+    for method, function in (("hardlink", link_file), ("reflink", _reflink), ("kernel copy", _copy_in_kernel)):
         try:
-            with requests.get(url, headers=headers, stream=True, timeout=(9, 27)) as response_handler:
-                status_code = response_handler.status_code
+            function(source, destination)
+            break
+        except (ImportError, OSError) as e:
+            logger.debug(f"Couldn't {method} {source} to {destination}: {e}")
+    else:
+        method = "copy"
+        _copy(source, destination)
 
-                if ((response_handler.status_code in (403, 404, 405, 500)) or
-                    (part_size == 0 and response_handler.status_code != 200) or
-                    (part_size > 0 and response_handler.status_code != 206)):
-                    _print(
-                        f"Couldn't download the file from {url}."
-                        f"{NEW_LINE}"
-                        f"Status code: {status_code}"
-                        f"{NEW_LINE}"
-                    )
-                    return
+    # The server's copy is only dropped once ours is known to be whole
+    source_size = os.path.getsize(source)
+    destination_size = os.path.getsize(destination)
+    if destination_size != source_size:
+        raise OSError(errno.EIO, f"{destination} has {destination_size} of {source_size} bytes after a {method}")
 
-                content_length = response_handler.headers.get("Content-Length")
-                content_range = response_handler.headers.get("Content-Range")
-                has_size = content_length if part_size == 0 \
-                    else content_range.split("/")[-1] if content_range else None
+    try:
+        # The server's copy is no longer needed, like a move
+        os.remove(source)
+    except OSError as e:
+        logger.warning(f"Couldn't remove {source} after ingesting it: {e}")
+    return method
+
+# Output volumes and free space admission
+class InsufficientSpace(Exception):
+    """No output volume has room for a download."""
+
+def _existing_ancestor(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+def _allocated(stat: os.stat_result) -> int:
+    # st_blocks also counts what fallocate reserved past the end of a file
+    blocks = getattr(stat, "st_blocks", None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+def allocated_size(path: str) -> int:
+    """Disk space taken by a file, or all files under a directory, 0 when it doesn't exist."""
+    try:
+        if not os.path.isdir(path):
+            return _allocated(os.stat(path))
+    except OSError:
+        return 0
+
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += _allocated(os.lstat(os.path.join(root, name)))
+            except OSError:
+                pass
+    return total
+
+class Reservation:
+    """Space set aside on a filesystem for one download, until released."""
+
+    def __init__(self, volumes: "OutputVolumes", directory: str, device: int, size: int) -> None:
+        self._volumes = volumes
+        self.directory = directory
+        self.device = device
+        self.size = size
+        self._path = None
+        self._baseline = 0
+
+    def track(self, path: str) -> None:
+        """Count what path grows by from now on against the reservation, so it isn't taken off the free space twice."""
+        self._baseline = allocated_size(path)
+        self._path = path
+
+    def outstanding(self) -> int:
+        """Bytes still to be written to disk."""
+        if not self.size or not self._path:
+            return self.size
+        return max(self.size - (allocated_size(self._path) - self._baseline), 0)
+
+    def release(self) -> None:
+        self._volumes.release(self)
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+class OutputVolumes:
+    """
+    Directories downloads are spread over, and the space running downloads still need on each.
+
+    A download is only admitted where the free space, less what running downloads still have to
+    write and FREE_SPACE_MARGIN, fits its size. Among the volumes it fits on, the one with the best
+    measured write speed per running download gets it, so several disks are written in parallel.
+    Reservations are per process, and disk space a download preallocated is already taken off
+    the free space, so other processes only see a job's reservation once it has started writing.
+    """
+
+    def __init__(self, roots: list[str], margin: int) -> None:
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.margin = margin
+        self._reservations = []
+        self._speeds = {}
+        # What the last status() found, for callers that can't wait on the disk
+        self._last_status = []
+        # Guards the three above and is only held for a copy or an update, never around disk I/O, so the
+        # writer threads recording speeds don't wait on an admission or a metrics scrape walking the disk
+        self._lock = Lock()
+        # One admission at a time, so two downloads can't both be given the same free space
+        self._admission = Lock()
+
+    def _snapshot(self) -> tuple[list[Reservation], dict[int, float]]:
+        with self._lock:
+            return list(self._reservations), dict(self._speeds)
+
+    def _free(self, directory: str, reservations: list[Reservation]) -> tuple[int, int]:
+        existing = _existing_ancestor(directory)
+        device = os.stat(existing).st_dev
+        promised = sum(
+            reservation.outstanding() for reservation in reservations if reservation.device == device
+        )
+        return disk_usage(existing).free - promised - self.margin, device
+
+    def candidates(self, directory: str) -> list[str]:
+        """Where a download into directory may go: every volume when it is one of them, else only directory."""
+        return self.roots if os.path.abspath(directory) in self.roots else [directory]
+
+    def reserve(self, directory: str, size: int | None, spread: bool = False) -> Reservation:
+        """
+        Set aside size bytes (None when unknown) for a download into directory, or raise InsufficientSpace.
+        With spread, a directory that is one of the volumes may be swapped for whichever suits the download best.
+        """
+        candidates = self.candidates(directory) if spread else [directory]
+        with self._admission:
+            # Reservations released meanwhile only make the estimate err on the safe side
+            reservations, speeds = self._snapshot()
+            # Volumes nothing was written to yet are assumed to be as fast as the fastest one
+            fastest = max(speeds.values(), default=1.0)
+            best = None
+            most_free = None
+            for candidate in candidates:
+                try:
+                    free, device = self._free(candidate, reservations)
+                except OSError as e:
+                    logger.warning(f"Couldn't check free space in {candidate}: {e}")
+                    continue
+                most_free = free if most_free is None else max(most_free, free)
+                if free < (size or 0):
+                    continue
+
+                running = sum(reservation.device == device for reservation in reservations)
+                score = (speeds.get(device, fastest) / (1 + running), free)
+                if best is None or score > best[0]:
+                    best = (score, candidate, device)
+
+            if best is None:
+                # The margin is reported on its own, so the numbers match the file and what df shows
+                available = "unknown" if most_free is None else humanize.naturalsize(max(most_free + self.margin, 0))
+                raise InsufficientSpace(
+                    f"Not enough free space in {', '.join(candidates)} for {humanize.naturalsize(size or 0)}: "
+                    f"{available} free, {humanize.naturalsize(self.margin)} of it kept spare"
+                )
+
+            reservation = Reservation(self, best[1], best[2], size or 0)
+            with self._lock:
+                self._reservations.append(reservation)
+        return reservation
+
+    def release(self, reservation: Reservation) -> None:
+        with self._lock:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+
+    def record_write(self, device: int, amount: int, elapsed: float) -> None:
+        """Fold a timed write into the device's write speed estimate."""
+        if elapsed <= 0:
+            return
+        speed = amount / elapsed
+        with self._lock:
+            previous = self._speeds.get(device)
+            self._speeds[device] = speed if previous is None else previous * 0.9 + speed * 0.1
+
+    def status(self, directories: list[str]) -> list[tuple[str, int, float | None]]:
+        """(directory, free bytes for new downloads, measured write speed) of each directory that can be checked."""
+        reservations, speeds = self._snapshot()
+        rows = []
+        for directory in directories:
+            try:
+                free, device = self._free(directory, reservations)
+            except OSError:
+                continue
+            rows.append((directory, max(free, 0), speeds.get(device)))
+        with self._lock:
+            self._last_status = rows
+        return rows
+
+    def last_status(self) -> list[tuple[str, int, float | None]]:
+        """The rows of the last status() call, without touching the disk."""
+        with self._lock:
+            return list(self._last_status)
+
+volumes = OutputVolumes(OUTPUT_VOLUMES, FREE_SPACE_MARGIN)
+
+# Disk write path
+FALLOC_FL_KEEP_SIZE = 0x01
+_fallocate = None
+
+def preallocate(fd: int, offset: int, length: int, keep_size: bool = False) -> None:
+    """
+    Reserve disk blocks for length bytes at offset, so the file isn't fragmented and a full disk fails now.
+    keep_size leaves the apparent size alone, so a streamed .part still tells how much was written.
+    """
+    global _fallocate
+    if length <= 0 or system() != "Linux":
+        return
+
+    if _fallocate is None:
+        _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+        _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE if keep_size else 0, offset, length) != 0:
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+            raise OSError(error, os.strerror(error))
+        # Filesystems without fallocate just end up with a more fragmented file
+        logger.debug(f"fallocate failed: {os.strerror(error)}")
+
+def read_chunks(response: requests.Response, sizer: "ChunkSizer"):
+    """Like iter_content, but each read asks for sizer.size bytes, so the chunk size can change mid-stream."""
+    try:
+        while chunk := response.raw.read(sizer.size, decode_content=True):
+            yield chunk
+    # Same translation iter_content does, so callers keep catching requests exceptions
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+
+class ChunkSizer:
+    """Double or halve the read size so one chunk holds about WRITE_CHUNK_SECONDS of the measured throughput."""
+
+    def __init__(self, maximum: int = HTTP_CHUNK_SIZE, minimum: int = WRITE_CHUNK_MIN) -> None:
+        self.minimum = min(minimum, maximum)
+        self.maximum = maximum
+        self.size = self.minimum
+        self._last = time.monotonic()
+
+    def update(self, amount: int) -> int:
+        """Account for amount bytes received since the last call, return the next read size."""
+        now = time.monotonic()
+        elapsed, self._last = now - self._last, now
+        target = amount / elapsed * WRITE_CHUNK_SECONDS if elapsed > 0 else self.maximum
+
+        if target >= 2 * self.size:
+            self.size = min(self.size * 2, self.maximum)
+        elif target < self.size // 2:
+            self.size = max(self.size // 2, self.minimum)
+        return self.size
+
+class FileWriter:
+    """
+    Write downloaded buffers from a thread of its own, so a slow disk doesn't stall the network reads.
+
+    Buffers go to pwritev as they were received, without being joined or copied. The queue in
+    between is bounded, so a disk that can't keep up slows the download instead of filling memory.
+    """
+
+    def __init__(self, path: str, position: int | None = 0, size: int | None = None, digests: tuple = ()) -> None:
+        """
+        Open path for writing at position, truncating anything past it and reserving room up to size.
+        A position of None leaves the file as it is, for writers that always pass an offset.
+        Sequentially written data is also fed to digests.
+        """
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+        if position is not None:
+            os.ftruncate(self._fd, position)
+            if size:
+                preallocate(self._fd, position, size - position, keep_size=True)
+
+        self._position = position or 0
+        self._digests = digests
+        self._device = os.fstat(self._fd).st_dev
+        self._queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._enqueue_lock = Lock()
+        self._written = Condition()
+        self._queued_count = 0
+        self._written_count = 0
+        self._unsynced = 0
+        self._error = None
+        self._thread = Thread(target=self._run, name="writer", daemon=True)
+        self._thread.start()
+
+    def _enqueue(self, buffers: list, offset: int | None, block: bool = True) -> None:
+        with self._enqueue_lock:
+            if offset is None:
+                offset = self._position
+            self._queue.put((offset, buffers), block=block)
+            self._position = offset + sum(len(buffer) for buffer in buffers)
+            self._queued_count += 1
+
+    def write(self, buffers: list, offset: int | None = None) -> None:
+        """Queue buffers for offset (right after the previous ones when None), blocking while the queue is full."""
+        if self._error:
+            raise self._error
+        self._enqueue(buffers, offset)
+
+    async def write_async(self, buffers: list, offset: int | None = None) -> None:
+        """write() for the event loop, which only leaves it while the queue is full."""
+        if self._error:
+            raise self._error
+        try:
+            self._enqueue(buffers, offset, block=False)
+        except queue.Full:
+            await asyncio.to_thread(self._enqueue, buffers, offset)
+
+    def flush(self) -> None:
+        """Wait until everything queued so far is on disk (in the page cache, see FSYNC_POLICY)."""
+        with self._enqueue_lock:
+            target = self._queued_count
+        with self._written:
+            self._written.wait_for(lambda: self._written_count >= target)
+        if self._error:
+            raise self._error
+
+    def close(self) -> None:
+        """Write out the queue, sync as FSYNC_POLICY asks and close, raising the first write error."""
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if not self._error and FSYNC_POLICY != "none":
+                os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+
+        if self._error:
+            raise self._error
+
+    def _run(self) -> None:
+        while (item := self._queue.get()) is not None:
+            # After an error the queue is still drained, so producers never block on it
+            if not self._error:
+                try:
+                    self._write(*item)
+                except OSError as e:
+                    self._error = e
+
+            with self._written:
+                self._written_count += 1
+                self._written.notify_all()
+
+    def _write(self, offset: int, buffers: list) -> None:
+        views = [memoryview(buffer) for buffer in buffers]
+        total = sum(view.nbytes for view in views)
+        started = time.monotonic()
+
+        while views:
+            if hasattr(os, "pwritev"):
+                written = os.pwritev(self._fd, views, offset)
+            else:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                written = os.write(self._fd, views[0])
+            offset += written
+
+            # Short writes are allowed, carry on with whatever is left
+            while views and written >= views[0].nbytes:
+                written -= views[0].nbytes
+                views.pop(0)
+            if written:
+                views[0] = views[0][written:]
+        # Only time spent writing counts, so placement compares disks rather than downloads
+        elapsed = time.monotonic() - started
+
+        for digest in self._digests:
+            for buffer in buffers:
+                digest.update(buffer)
+
+        if FSYNC_POLICY == "interval":
+            self._unsynced += total
+            if self._unsynced >= FSYNC_INTERVAL:
+                started = time.monotonic()
+                getattr(os, "fdatasync", os.fsync)(self._fd)
+                elapsed += time.monotonic() - started
+                self._unsynced = 0
+
+        volumes.record_write(self._device, total, elapsed)
+
+# Streaming archive extraction
+ARCHIVE_SUFFIXES = (
+    (".tar.gz", "tar"), (".tgz", "tar"), (".tar.bz2", "tar"), (".tbz2", "tar"), (".tar.xz", "tar"),
+    (".txz", "tar"), (".tar", "tar"), (".tar.zst", "tar.zst"), (".tzst", "tar.zst"), (".zip", "zip"),
+)
+
+def archive_format(filename: str) -> str | None:
+    """"tar", "tar.zst" or "zip" when filename names an archive --extract can unpack, else None."""
+    lowered = filename.lower()
+    for suffix, kind in ARCHIVE_SUFFIXES:
+        if lowered.endswith(suffix):
+            return kind
+    return None
+
+def archive_stem(filename: str) -> str:
+    """filename without its archive suffix, the directory its contents are extracted to."""
+    lowered = filename.lower()
+    for suffix, _ in ARCHIVE_SUFFIXES:
+        if lowered.endswith(suffix) and len(filename) > len(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def reserve_dirpath(directory: str, name: str) -> str:
+    """Create an empty directory named name (or name(n)) in directory so nothing gets mixed together."""
+    candidate = name
+    for count in itertools.count(1):
+        dirpath = os.path.join(directory, candidate)
+        try:
+            os.mkdir(dirpath)
+            return dirpath
+        except FileExistsError:
+            candidate = f"{name}({count})"
+
+def path_size(path: str) -> int:
+    """Size of a file, or of all files under a directory, 0 when it doesn't exist."""
+    if not os.path.isdir(path):
+        return file_size(path)
+    return sum(
+        file_size(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+class _ChunkStream(io.RawIOBase):
+    """Read end of a bounded queue of buffers, so tarfile can read a download as it arrives."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._buffer = memoryview(b"")
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self._buffer:
+            if self._eof:
+                return 0
+            item = self.queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            self._buffer = memoryview(item)
+
+        count = min(len(target), len(self._buffer))
+        target[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+    def drain(self) -> None:
+        """Skip whatever is left, so the writing side never blocks on a queue nobody reads."""
+        while not self._eof:
+            self._eof = self.queue.get() is None
+
+def _safe_tar_member(member: tarfile.TarInfo, path: str) -> tarfile.TarInfo | None:
+    """Skip members that would land outside path (or aren't plain data), instead of failing the whole archive."""
+    if hasattr(tarfile, "data_filter"):
+        try:
+            return tarfile.data_filter(member, path)
+        except tarfile.FilterError as e:
+            logger.warning(f"Skipping archive member {member.name}: {e}")
+            return None
+
+    # Pythons without extraction filters only get plain files and directories inside path
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name.startswith("..") or not (member.isfile() or member.isdir()):
+        logger.warning(f"Skipping archive member {member.name}")
+        return None
+    return member
+
+def _safe_tar_members(archive: tarfile.TarFile, path: str):
+    """The members of archive _safe_tar_member lets through, for Pythons whose extractall has no filter."""
+    for member in archive:
+        if _safe_tar_member(member, path) is not None:
+            yield member
+
+class ArchiveExtractor:
+    """
+    Unpack an archive into a directory while it downloads, so the archive itself is never kept.
+
+    Tar archives, compressed or not, are read as a stream by a thread of their own. Zip keeps its
+    index at the end, so a zip is spilled to a temporary file beside the directory and unpacked once
+    the last byte is in. Either way the bytes written are also fed to digests.
+    """
+
+    def __init__(self, directory: str, kind: str, digests: tuple = ()) -> None:
+        if kind == "tar.zst" and zstandard is None:
+            raise ValueError("extracting .tar.zst archives needs the zstandard package")
+
+        self.directory = directory
+        self._kind = kind
+        self._digests = digests
+        self._error = None
+        if kind == "zip":
+            self._spill = f"{directory}.zip.part"
+            self._writer = FileWriter(self._spill, digests=digests)
+        else:
+            self._stream = _ChunkStream()
+            self._thread = Thread(target=self._extract_tar, name="extract", daemon=True)
+            self._thread.start()
+
+    def _extract_tar(self) -> None:
+        try:
+            source = self._stream
+            if self._kind == "tar.zst":
+                source = zstandard.ZstdDecompressor().stream_reader(self._stream)
+            with tarfile.open(fileobj=source, mode="r|*") as archive:
+                if hasattr(tarfile, "data_filter"):
+                    archive.extractall(self.directory, filter=_safe_tar_member)
+                else:
+                    # Older Pythons reject the filter keyword, so unsafe members are left out up front
+                    archive.extractall(self.directory, members=_safe_tar_members(archive, self.directory))
+        except Exception as e:
+            self._error = e
+        finally:
+            # Trailing padding after the end of the archive is never read by tarfile
+            self._stream.drain()
+
+    def write(self, buffers: list) -> None:
+        """Hand over the next buffers of the archive, blocking while extraction is behind."""
+        if self._kind == "zip":
+            self._writer.write(buffers)
+            return
+
+        if self._error:
+            raise self._error
+        for buffer in buffers:
+            for digest in self._digests:
+                digest.update(buffer)
+            self._stream.queue.put(buffer)
+
+    async def write_async(self, buffers: list) -> None:
+        """write() for the event loop, which only leaves it while extraction is behind."""
+        if self._kind == "zip":
+            await self._writer.write_async(buffers)
+        elif self._stream.queue.qsize() + len(buffers) <= WRITE_QUEUE_SIZE and not self._error:
+            self.write(buffers)
+        else:
+            await asyncio.to_thread(self.write, buffers)
+
+    def close(self) -> None:
+        """Finish extracting everything written so far, raising the first error."""
+        if self._kind == "zip":
+            try:
+                self._writer.close()
+                with zipfile.ZipFile(self._spill) as archive:
+                    archive.extractall(self.directory)
+            finally:
+                if os.path.exists(self._spill):
+                    os.remove(self._spill)
+            return
+
+        self._stream.queue.put(None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    def abort(self) -> None:
+        """Stop after a failed download without reporting the truncated archive as another error."""
+        try:
+            self.close()
+        except Exception as e:
+            logger.debug(f"Extraction into {self.directory} stopped: {e}")
+
+# Crash-safe download journal
+class RemoteFileChanged(Exception):
+    """The remote file no longer matches the validators recorded for a partial download."""
+
+class ChecksumMismatch(Exception):
+    """A finished download doesn't match the checksum its listing gave."""
+
+class DownloadJournal(SqliteStore):
+    """SQLite journal of unfinished jobs and partial transfers, so both survive a restart."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            url TEXT NOT NULL,
+            password TEXT,
+            chat_id INTEGER NOT NULL,
+            output_dir TEXT NOT NULL,
+            target TEXT,
+            extract INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS transfers (
+            target TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            size INTEGER,
+            etag TEXT,
+            last_modified TEXT,
+            segments TEXT
+        );
+    """
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = super()._connect()
+            # Journals created before --extract don't have the column
+            if "extract" not in {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}:
+                db.execute("ALTER TABLE jobs ADD COLUMN extract INTEGER NOT NULL DEFAULT 0")
+                db.commit()
+        return self._db
+
+    def begin_job(self, kind: str, url: str, chat_id: int, output_dir: str, password: str | None = None,
+                  extract: bool = False) -> int:
+        """Record a user job that should be restarted if the bot dies before finish_job."""
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO jobs (kind, url, password, chat_id, output_dir, extract, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, url, password, chat_id, output_dir, int(extract), time.time())
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def set_job_target(self, job_id: int | None, target: str) -> None:
+        if job_id is None:
+            return
+        with self._lock:
+            self._connect().execute("UPDATE jobs SET target = ? WHERE id = ?", (target, job_id))
+            self._db.commit()
+
+    def finish_job(self, job_id: int | None) -> None:
+        if job_id is None:
+            return
+        with self._lock:
+            self._connect().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._db.commit()
+
+    def job_target(self, job_id: int) -> str | None:
+        with self._lock:
+            row = self._connect().execute("SELECT target FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["target"] if row else None
+
+    def unfinished_jobs(self) -> list[dict]:
+        with self._lock:
+            return [dict(row) for row in self._connect().execute("SELECT * FROM jobs ORDER BY id")]
+
+    def get_transfer(self, target: str) -> dict | None:
+        """Saved state of a partial transfer, segments decoded to [[position, end], ...] or None."""
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM transfers WHERE target = ?", (target,)).fetchone()
+        if not row:
+            return None
+
+        transfer = dict(row)
+        transfer["segments"] = json.loads(transfer["segments"]) if transfer["segments"] else None
+        return transfer
+
+    def save_transfer(self, target: str, url: str, size: int | None, response_headers, segments: list | None = None) -> None:
+        """Start journaling a transfer along with the validators the server sent for it."""
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO transfers (target, url, size, etag, last_modified, segments) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    target, url, size,
+                    response_headers.get("ETag") if response_headers else None,
+                    response_headers.get("Last-Modified") if response_headers else None,
+                    json.dumps(segments) if segments is not None else None
+                )
+            )
+            self._db.commit()
+
+    def save_segments(self, target: str, segments: list) -> None:
+        with self._lock:
+            self._connect().execute(
+                "UPDATE transfers SET segments = ? WHERE target = ?", (json.dumps(segments), target)
+            )
+            self._db.commit()
+
+    def drop_transfer(self, target: str) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM transfers WHERE target = ?", (target,))
+            self._db.commit()
+
+journal = DownloadJournal(JOURNAL_DB)
+
+def if_range_value(validators) -> str | None:
+    """Validator to send as If-Range, so a changed remote file is sent whole instead of appended."""
+    if not validators:
+        return None
+    etag = validators.get("etag") or validators.get("ETag")
+    # Weak ETags are not allowed in If-Range
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified") or validators.get("Last-Modified")
+
+# Upload file_id cache
+class UploadCache(SqliteStore):
+    """SQLite cache of the file_id Telegram assigned to each uploaded file, so unchanged files aren't sent twice."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploads (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            hash TEXT,
+            file_id TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'document',
+            used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS uploads_hash ON uploads (hash);
+        CREATE INDEX IF NOT EXISTS uploads_used ON uploads (used);
+    """
+
+    def __init__(self, db_path: str, max_entries: int, use_hash: bool = False) -> None:
+        super().__init__(db_path)
+        self._max_entries = max_entries
+        self._use_hash = use_hash
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = super()._connect()
+            # Caches created before album uploads only held documents
+            if "kind" not in {row["name"] for row in db.execute("PRAGMA table_info(uploads)")}:
+                db.execute("ALTER TABLE uploads ADD COLUMN kind TEXT NOT NULL DEFAULT 'document'")
+                db.commit()
+        return self._db
+
+    def find(self, path: str, kind: str = "document") -> tuple[os.stat_result, str | None, str | None]:
+        """
+        Current stat and hash of path, plus its cached file_id if the file is unchanged since it was sent.
+        A file_id only matches when it was sent as the same kind of media.
+        """
+        stat = os.stat(path)
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM uploads WHERE path = ?", (path,)).fetchone()
+            if row and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+                if row["kind"] != kind:
+                    return stat, row["hash"], None
+                self._touch(row["path"])
+                return stat, row["hash"], row["file_id"]
+            if row:
+                # Changed on disk since it was sent
+                self._db.execute("DELETE FROM uploads WHERE path = ?", (path,))
+                self._db.commit()
+
+        if not self._use_hash:
+            return stat, None, None
+
+        # A copy or rename of something already sent still has the same content
+        digest = hash_file(path)
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT path, file_id FROM uploads WHERE hash = ? AND size = ? AND kind = ? ORDER BY used DESC LIMIT 1",
+                (digest, stat.st_size, kind)
+            ).fetchone()
+            if row:
+                self._touch(row["path"])
+                return stat, digest, row["file_id"]
+        return stat, digest, None
+
+    def _touch(self, path: str) -> None:
+        self._db.execute("UPDATE uploads SET used = ? WHERE path = ?", (time.time(), path))
+        self._db.commit()
+
+    def add(self, path: str, stat: os.stat_result, digest: str | None, file_id: str, kind: str = "document") -> None:
+        """Remember the file_id of an upload, evicting the least recently used entries past the limit."""
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO uploads (path, size, mtime_ns, hash, file_id, kind, used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest, file_id, kind, time.time())
+            )
+            db.execute(
+                "DELETE FROM uploads WHERE path IN (SELECT path FROM uploads ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,)
+            )
+            db.commit()
+
+    def forget_file_id(self, file_id: str) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+            self._db.commit()
+
+upload_cache = UploadCache(UPLOAD_CACHE_DB, UPLOAD_CACHE_SIZE, UPLOAD_CACHE_HASH)
+
+# Download progress tracking
+class FileProgress:
+    """Byte counter for one file; workers only add to it, the tracker samples it."""
+    __slots__ = ("name", "total", "done", "counter", "finished", "speed", "_sampled_bytes")
+
+    def __init__(self, name: str, total: int | None = None, done: int = 0) -> None:
+        self.name = name
+        self.total = total
+        self.done = done
+        self.counter = None
+        self.finished = False
+        self.speed = 0.0
+        self._sampled_bytes = done
+
+    def current(self) -> int:
+        """Bytes downloaded so far, read from counter when several workers share the file."""
+        return self.counter() if self.counter else self.done
+
+    @property
+    def eta(self) -> float | None:
+        if not self.total or self.speed <= 0:
+            return None
+        return max(self.total - self.current(), 0) / self.speed
+
+class ProgressTracker:
+    """Samples the byte counters of one job on a timer and derives EWMA speed and ETA."""
+
+    def __init__(self, interval: float = UPDATE_INTERVAL, smoothing: float = 0.3) -> None:
+        self._interval = interval
+        self._smoothing = smoothing
+        self._files = []
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._last_sample = time.monotonic()
+        self.speed = 0.0
+
+    def track(self, name: str, total: int | None = None, done: int = 0) -> FileProgress:
+        """Register a file and return the counter its worker should update."""
+        progress = FileProgress(name, total, done)
+        with self._lock:
+            self._files.append(progress)
+        return progress
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="progress", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self.sample()
+
+    def sample(self) -> None:
+        """Update per-file and job speeds from the bytes counted since the last sample."""
+        now = time.monotonic()
+        elapsed = now - self._last_sample
+        if elapsed <= 0:
+            return
+        self._last_sample = now
+
+        with self._lock:
+            files = list(self._files)
+
+        job_rate = 0.0
+        for progress in files:
+            current = progress.current()
+            rate = (current - progress._sampled_bytes) / elapsed
+            progress._sampled_bytes = current
+            progress.speed = rate if progress.speed == 0 else \
+                self._smoothing * rate + (1 - self._smoothing) * progress.speed
+            if not progress.finished:
+                job_rate += rate
+
+        self.speed = job_rate if self.speed == 0 else \
+            self._smoothing * job_rate + (1 - self._smoothing) * self.speed
+
+    def summary(self) -> dict:
+        """Totals across every tracked file."""
+        with self._lock:
+            files = list(self._files)
+
+        done = sum(progress.current() for progress in files)
+        total = sum(progress.total or 0 for progress in files)
+        return {
+            "files": len(files),
+            "finished": sum(1 for progress in files if progress.finished),
+            "done": done,
+            "total": total,
+            "speed": self.speed,
+            "eta": (total - done) / self.speed if total and self.speed > 0 else None,
+            "active": [progress for progress in files if not progress.finished]
+        }
+
+    def format(self, limit: int = 5) -> str:
+        """Human readable status for a Telegram message."""
+        summary = self.summary()
+        eta = humanize.naturaldelta(summary["eta"]) if summary["eta"] is not None else "unknown"
+        lines = [
+            f"{summary['finished']}/{summary['files']} files • "
+            f"{humanize.naturalsize(summary['done'])} of {humanize.naturalsize(summary['total'])} • "
+            f"{humanize.naturalsize(summary['speed'])}/s • ETA {eta}"
+        ]
+
+        for progress in summary["active"][:limit]:
+            percent = f"{progress.current() / progress.total * 100:.1f}%" if progress.total else "?"
+            eta = f" ETA {humanize.naturaldelta(progress.eta)}" if progress.eta is not None else ""
+            lines.append(f"▸ {progress.name} {percent} {humanize.naturalsize(progress.speed)}/s{eta}")
+
+        if len(summary["active"]) > limit:
+            lines.append(f"… and {len(summary['active']) - limit} more")
+
+        return "\n".join(lines)
+
+# Bandwidth shaping
+RATE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_rate(value: str) -> int:
+    """Bytes per second from values like "0", "off", "512K", "10M" or "1.5GB/s"; 0 means unlimited."""
+    value = value.strip().upper().removesuffix("/S").removesuffix("B")
+    if value in ("", "0", "OFF", "NONE"):
+        return 0
+    if value[-1] in RATE_UNITS:
+        return int(float(value[:-1]) * RATE_UNITS[value[-1]])
+    return int(float(value))
+
+def parse_schedule(value: str) -> list[tuple[int, int, int]]:
+    """Parse "HH:MM-HH:MM=rate,..." into (start minute, end minute, rate) windows; windows may wrap midnight."""
+    windows = []
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        hours, _, rate = item.partition("=")
+        start, _, end = hours.partition("-")
+        minutes = []
+        for clock in (start, end):
+            hour, _, minute = clock.strip().partition(":")
+            minutes.append(int(hour) * 60 + int(minute or 0))
+        windows.append((minutes[0], minutes[1], parse_rate(rate)))
+    return windows
+
+def format_rate(rate: int) -> str:
+    return f"{humanize.naturalsize(rate, binary=True)}/s" if rate else "unlimited"
+
+class TokenBucket:
+    """Thread-safe token bucket holding up to one second of traffic; a rate of 0 means unlimited."""
+
+    def __init__(self, rate: int = 0) -> None:
+        self.rate = rate
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self, amount: int) -> float:
+        """Take amount bytes out of the bucket, returning how long to wait before sending them."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed, self._updated = now - self._updated, now
+            if self.rate <= 0:
+                self._tokens = 0.0
+                return 0.0
+
+            # Going into debt lets one large reservation (a whole upload) wait its turn
+            self._tokens = min(float(self.rate), self._tokens + elapsed * self.rate) - amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+class Throttle:
+    """What one job's transfers draw from: the global bucket, their chat's bucket and the job's own."""
+
+    def __init__(self, shaper: "BandwidthShaper", chat: TokenBucket, job: TokenBucket, host: str, description: str) -> None:
+        self._shaper = shaper
+        self._chat = chat
+        self.job = job
+        self.host = host
+        self.description = description
+        self.transferred = 0
+        # Bytes the transfer is expected to move, once known
+        self.total = None
+        self.started = time.monotonic()
+        self._lock = Lock()
+
+    def _reserve(self, amount: int) -> float:
+        with self._lock:
+            self.transferred += amount
+        transferred_bytes.inc(amount, direction=self._shaper.direction, host=self.host)
+        return self._shaper.reserve(amount, self._chat, self.job)
+
+    def consume(self, amount: int) -> None:
+        """Block the calling thread until amount bytes fit under every limit."""
+        delay = self._reserve(amount)
+        if delay:
+            time.sleep(delay)
+
+    async def wait(self, amount: int) -> None:
+        delay = self._reserve(amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def speed(self) -> float:
+        """Average bytes per second since the job started."""
+        return self.transferred / max(time.monotonic() - self.started, 1e-3)
+
+class BandwidthShaper:
+    """Global, per-chat and per-job limits for one direction of traffic, with a time-of-day schedule for the global one."""
+    SCOPES = ("global", "chat", "job")
+
+    def __init__(self, name: str, direction: str, limits: dict[str, int], schedule: list[tuple[int, int, int]]) -> None:
+        self.name = name
+        self.direction = direction
+        self.limits = dict(limits)
+        self.schedule = schedule
+        self._global = TokenBucket(self.global_rate())
+        # Buckets of chats and jobs with no transfer running are dropped on their own
+        self._chats = WeakValueDictionary()
+        self._throttles = WeakSet()
+        self._lock = Lock()
+
+    def global_rate(self) -> int:
+        """The global limit right now, from the first schedule window covering the local time."""
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.limits["global"]
+
+    def throttle(self, chat_id: int, host: str, description: str) -> Throttle:
+        """Buckets for a new job in chat_id, also counting its traffic under host."""
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = TokenBucket(self.limits["chat"])
+            throttle = Throttle(self, chat, TokenBucket(self.limits["job"]), host, description)
+            self._throttles.add(throttle)
+        return throttle
+
+    def throttles(self) -> list[Throttle]:
+        """Throttles of the jobs still running."""
+        with self._lock:
+            return list(self._throttles)
+
+    def reserve(self, amount: int, *buckets: TokenBucket) -> float:
+        self._global.rate = self.global_rate()
+        return max(bucket.reserve(amount) for bucket in (self._global, *buckets))
+
+    def set_limit(self, scope: str, rate: int) -> None:
+        """Change a limit for running and future jobs; setting the global limit replaces the schedule."""
+        with self._lock:
+            self.limits[scope] = rate
+            if scope == "global":
+                self.schedule = []
+                buckets = [self._global]
+            else:
+                buckets = list(self._chats.values()) if scope == "chat" else [throttle.job for throttle in self._throttles]
+            for bucket in buckets:
+                bucket.rate = rate
+
+    def describe(self) -> str:
+        schedule = ", ".join(
+            f"{start // 60:02}:{start % 60:02}-{end // 60:02}:{end % 60:02} {format_rate(rate)}"
+            for start, end, rate in self.schedule
+        )
+        return (
+            f"{self.name}: global {format_rate(self.limits['global'])}"
+            f"{f' (schedule: {schedule}, now {format_rate(self.global_rate())})' if schedule else ''}, "
+            f"per chat {format_rate(self.limits['chat'])}, per job {format_rate(self.limits['job'])}"
+        )
+
+download_shaper = BandwidthShaper(
+    "⬇️ Downloads", "download",
+    {"global": parse_rate(DOWNLOAD_LIMIT), "chat": parse_rate(DOWNLOAD_LIMIT_PER_CHAT), "job": parse_rate(DOWNLOAD_LIMIT_PER_JOB)},
+    parse_schedule(DOWNLOAD_SCHEDULE)
+)
+upload_shaper = BandwidthShaper(
+    "⬆️ Uploads", "upload",
+    {"global": parse_rate(UPLOAD_LIMIT), "chat": parse_rate(UPLOAD_LIMIT_PER_CHAT), "job": parse_rate(UPLOAD_LIMIT_PER_JOB)},
+    parse_schedule(UPLOAD_SCHEDULE)
+)
+
+# Segmented downloads
+class _Segment:
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.position = start
+        self.end = end  # exclusive
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.position
+
+class SegmentedDownloader:
+    """Fetch a file over several parallel HTTP Range requests into a preallocated file."""
+
+    def __init__(self, url: str, headers: dict | None = None, segments: int = SEGMENT_COUNT,
+                 chunk_size: int = min(HTTP_CHUNK_SIZE, SEGMENT_SPLIT_MIN),
+                 validator: str | None = None, checkpoint=None, throttle: Throttle | None = None) -> None:
+        self._url = url
+        self._headers = dict(headers or {})
+        # Byte offsets only line up if the server sends the raw bytes
+        self._headers["Accept-Encoding"] = "identity"
+        self._headers.pop("Range", None)
+        if validator:
+            self._headers["If-Range"] = validator
+        self._segment_count = max(1, segments)
+        self._chunk_size = chunk_size
+        self._checkpoint = checkpoint
+        self._throttle = throttle
+        self._last_checkpoint = 0.0
+        self._lock = Lock()
+        self._segments = []
+        self._size = 0
+        self._writer = None
+
+    @staticmethod
+    def probe(url: str, headers: dict | None = None) -> tuple[int | None, dict]:
+        """Return the file size if the server accepts byte ranges (else None) and the response headers."""
+        probe_headers = dict(headers or {})
+        probe_headers["Accept-Encoding"] = "identity"
+        probe_headers["Range"] = "bytes=0-0"
+
+        try:
+            with get_requests_session().get(url, headers=probe_headers, stream=True, timeout=(9, 27)) as response:
+                content_range = response.headers.get("Content-Range", "")
+                if response.status_code != 206 or "/" not in content_range:
+                    return None, response.headers
+
+                total = content_range.split("/")[-1]
+                return (int(total) if total.isdigit() else None), response.headers
+        except requests.RequestException as e:
+            logger.warning(f"Range probe failed for {url}: {e}")
+            return None, {}
+
+    @property
+    def downloaded(self) -> int:
+        """Bytes written so far across all segments, including ones from a resumed run."""
+        return self._size - sum(max(segment.remaining, 0) for segment in self._segments)
+
+    def segments(self) -> list[list[int]]:
+        """Unfinished byte ranges as [[position, end], ...], the state a resumed run needs."""
+        with self._lock:
+            return [[segment.position, segment.end] for segment in self._segments if segment.remaining > 0]
+
+    def download(self, filepath: str, size: int, progress: FileProgress | None = None, resume: list | None = None) -> bool:
+        """Download into filepath (or continue the resume ranges), return True only if every byte range completed."""
+        self._size = size
+        if progress:
+            progress.counter = lambda: self.downloaded
+
+        # An empty list can't be told apart from a plan that never got journaled, so it starts over
+        if resume and os.path.isfile(filepath) and os.path.getsize(filepath) == size:
+            self._segments = [_Segment(position, end) for position, end in resume]
+        else:
+            self._segments = [_Segment(position, end) for position, end in self.plan(size)]
+            # Journaled before the file exists, so a crash or a full disk while preallocating resumes every range
+            if self._checkpoint:
+                self._checkpoint(self.plan(size))
+
+            # Preallocate so every segment can write at its own offset
+            with open(filepath, "wb") as handler:
+                handler.truncate(size)
+                preallocate(handler.fileno(), 0, size)
+
+        # All segments share one writer thread, so disk writes never hold up the connections
+        self._writer = FileWriter(filepath, position=None)
+        try:
+            # The plan is saved before any byte lands, so a crash never looks like a finished file
+            self._save_checkpoint(force=True)
+
+            futures = [_segment_executor.submit(self._worker, segment) for segment in list(self._segments)]
+            errors = [future.exception() for future in futures]
+        finally:
+            self._writer.close()
+        self._save_checkpoint(force=True)
+
+        for error in errors:
+            if error:
+                raise error
+
+        return all(segment.remaining <= 0 for segment in self._segments)
+
+    def plan(self, size: int) -> list[list[int]]:
+        """The [[position, end], ...] ranges a fresh download of size bytes is split into."""
+        step = -(-size // self._segment_count)
+        return [[start, min(start + step, size)] for start in range(0, size, step)]
+
+    def _save_checkpoint(self, force: bool = False) -> None:
+        """Hand the unfinished ranges to the checkpoint callback at most every JOURNAL_CHECKPOINT_INTERVAL."""
+        if not self._checkpoint:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_checkpoint < JOURNAL_CHECKPOINT_INTERVAL:
+                return
+            self._last_checkpoint = now
+
+        segments = self.segments()
+        # Only ranges that reached the file may be journaled, else a crash leaves holes that look finished
+        self._writer.flush()
+        self._checkpoint(segments)
+
+    def _worker(self, segment: _Segment) -> None:
+        """Drain a segment, then keep stealing work from the slowest remaining one."""
+        while segment is not None:
+            for attempt in range(SEGMENT_RETRIES):
+                try:
+                    self._fetch(segment)
+                    break
+                except (requests.RequestException, OSError) as e:
+                    logger.warning(
+                        f"Segment {segment.position}-{segment.end} of {self._url} failed "
+                        f"(attempt {attempt + 1}/{SEGMENT_RETRIES}): {e}"
+                    )
+            if segment.remaining > 0:
+                return
+            segment = self._steal()
+
+    def _steal(self) -> _Segment | None:
+        """Split the segment with the most bytes left and hand its tail to the caller."""
+        with self._lock:
+            victim = max(self._segments, key=lambda segment: segment.remaining, default=None)
+            if victim is None or victim.remaining < 2 * SEGMENT_SPLIT_MIN:
+                return None
+
+            middle = victim.position + victim.remaining // 2
+            stolen = _Segment(middle, victim.end)
+            victim.end = middle
+            self._segments.append(stolen)
+            return stolen
+
+    def _fetch(self, segment: _Segment) -> None:
+        """Stream one byte range to its offset, stopping early if the range was shrunk."""
+        if segment.remaining <= 0:
+            return
+
+        headers = dict(self._headers)
+        headers["Range"] = f"bytes={segment.position}-{segment.end - 1}"
+
+        started = time.monotonic()
+        with get_requests_session().get(self._url, headers=headers, stream=True, timeout=(9, 27)) as response:
+            time_to_first_byte.observe(time.monotonic() - started, host=host_of(self._url))
+            if response.status_code == 200 and "If-Range" in headers:
+                raise RemoteFileChanged(f"{self._url} changed since the partial download started")
+            if response.status_code != 206:
+                raise requests.HTTPError(f"Expected 206 for ranged request, got {response.status_code}")
+
+            sizer = ChunkSizer(self._chunk_size)
+            for chunk in read_chunks(response, sizer):
+                # A steal never moves the end closer than SEGMENT_SPLIT_MIN and chunks are
+                # never larger, so the chunk being written can't overlap the stolen tail
+                with self._lock:
+                    remaining = segment.remaining
+                if remaining <= 0:
+                    break
+                if len(chunk) > remaining:
+                    chunk = memoryview(chunk)[:remaining]
+
+                if self._throttle:
+                    self._throttle.consume(len(chunk))
+                self._writer.write([chunk], segment.position)
+                sizer.update(len(chunk))
+
+                with self._lock:
+                    segment.position += len(chunk)
+                self._save_checkpoint()
+                if len(chunk) >= remaining:
+                    break
+
+def segmented_transfer(url: str, headers: dict | None, target: str, part_file: str, size: int,
+                       response_headers=None, progress: FileProgress | None = None,
+                       throttle: Throttle | None = None) -> bool:
+    """Run a journaled segmented download of url into part_file, continuing a journaled one for target."""
+    transfer = journal.get_transfer(target)
+
+    if transfer and transfer["segments"] and os.path.isfile(part_file):
+        resume, validator = transfer["segments"], if_range_value(transfer)
+    else:
+        resume, validator = None, if_range_value(response_headers)
+
+    downloader = SegmentedDownloader(
+        url, headers, validator=validator,
+        checkpoint=lambda segments: journal.save_segments(target, segments),
+        throttle=throttle
+    )
+    if resume is None:
+        # The planned ranges, never an empty list, which would read as every range finished
+        journal.save_transfer(target, url, size, response_headers, segments=downloader.plan(size))
+
+    try:
+        return downloader.download(part_file, size, progress, resume)
+    except RemoteFileChanged as e:
+        logger.warning(str(e))
+        return False
+
+# GoFile downloader class
+class GoFileDownloader:
+    def __init__(self, url: str, password: str | None = None, max_workers: int = 5, output_dir: str = None,
+                 progress: ProgressTracker | None = None, throttle: Throttle | None = None,
+                 extract: bool = False) -> None:
+        self._root_dir = output_dir if output_dir else os.getcwd()
+        self._lock = Lock()
+        self._max_workers = max_workers
+        token = os.getenv("GF_TOKEN")
+        self._fixed_token = bool(token)
+        self._content_dir = None
+        self._files_info = {}
+        # filepath: error of every listed file that couldn't be downloaded
+        self._failed = {}
+        self._files_index = 0
+        self._pathing_count = {}
+        self._token = token if token else self._get_token()
+        self.progress = progress if progress else ProgressTracker()
+        self._throttle = throttle
+        # Unpack listed archives into a directory of their own instead of keeping them
+        self._extract = extract
+        
+    def _crawl_and_download(self, content_id: str, password: str | None = None) -> None:
+        """Crawl the folder tree with bounded fan-out, downloading files as soon as they're found."""
+        events = queue.Queue()
+        folders = deque([(content_id, None)])
+        files = deque()
+        crawling = 0
+        downloading = 0
+
+        while folders or files or crawling or downloading:
+            while folders and crawling < GOFILE_CRAWL_FANOUT:
+                folder_id, parent_dir = folders.popleft()
+                future = _crawl_executor.submit(self._fetch_listing, folder_id, password)
+                future.add_done_callback(
+                    lambda f, folder_id=folder_id, parent_dir=parent_dir:
+                        events.put(("listing", (folder_id, parent_dir, f)))
+                )
+                crawling += 1
+
+            # Files run on the bot-wide pool, max_workers only caps this job's share of it
+            while files and downloading < self._max_workers:
+                file_info = files.popleft()
+                future = _file_executor.submit(self._download_content, file_info)
+                future.add_done_callback(lambda f, file_info=file_info: events.put(("file", (file_info, f))))
+                downloading += 1
+
+            kind, payload = events.get()
+
+            if kind == "file":
+                downloading -= 1
+                file_info, future = payload
+                if future.exception():
+                    _print(f"Download failed: {future.exception()}{NEW_LINE}", True)
+                    self._failed[os.path.join(file_info["path"], file_info["filename"])] = str(future.exception())
+                continue
+
+            crawling -= 1
+            folder_id, parent_dir, future = payload
+            if future.exception():
+                _print(f"Failed to list {folder_id}: {future.exception()}{NEW_LINE}", True)
+                continue
+
+            if future.result():
+                subfolders, found_files = self._handle_listing(folder_id, future.result(), parent_dir)
+                folders.extend(subfolders)
+                files.extend(found_files)
+
+    def _create_dir(self, dirname: str) -> None:
+        """Creates a directory where the files will be saved if it doesn't exist."""
+        try:
+            os.mkdir(dirname)
+        except FileExistsError:
+            pass
+
+    @staticmethod
+    def _get_token(refresh: bool = False) -> str:
+        """Gets the access token of the cached (or newly created) account."""
+        return get_gofile_token(refresh)
+
+    def _download_content(self, file_info: dict) -> None:
+        """Download a file unless an intact copy exists, again if the result fails its checksum."""
+        filepath = os.path.join(file_info["path"], file_info["filename"])
+        kind = archive_format(file_info["filename"]) if self._extract else None
+        if kind:
+            # Extractions only get their final name once complete
+            filepath = os.path.join(file_info["path"], archive_stem(file_info["filename"]))
+            if os.path.isdir(filepath):
+                _print(f"{filepath} already extracted, skipping.{NEW_LINE}")
+                return
+        elif self._is_downloaded(filepath, file_info):
+            _print(f"{filepath} already exist, skipping.{NEW_LINE}")
+            return
+
+        # Nothing is fetched unless the listed size fits on the disk
+        with volumes.reserve(file_info["path"], file_info.get("size")) as reservation:
+            reservation.track(f"{filepath}.part")
+            progress = self.progress.track(file_info["filename"])
+            for attempt in range(1, VERIFY_ATTEMPTS + 1):
+                try:
+                    if kind:
+                        self._extract_content(file_info, kind, filepath, progress)
+                    else:
+                        self._fetch_content(file_info, filepath, progress)
+                    return
+                except ChecksumMismatch as e:
+                    if attempt == VERIFY_ATTEMPTS:
+                        # Reaches the job result through the crawl coordinator's failed files
+                        raise ChecksumMismatch(f"{e} after {VERIFY_ATTEMPTS} attempts") from e
+                    _print(f"{e}, downloading again.{NEW_LINE}", True)
+
+    def _is_downloaded(self, filepath: str, file_info: dict) -> bool:
+        """Whether filepath already holds the listed file, by size and md5 when the listing has them."""
+        size = file_size(filepath)
+        if not size:
+            return False
+
+        if file_info.get("size") is not None and size != file_info["size"]:
+            _print(f"{filepath} is incomplete, downloading it again.{NEW_LINE}")
+            return False
+        if not file_info.get("md5"):
+            return True
+
+        md5_hex, digest = checksum_file(filepath)
+        if md5_hex != file_info["md5"]:
+            _print(f"{filepath} doesn't match its checksum, downloading it again.{NEW_LINE}")
+            return False
+
+        content_index.add(digest, filepath)
+        return True
+
+    def _verify(self, file_info: dict, md5_digest, filepath: str, tmp_file: str) -> None:
+        """Throw away a finished .part whose md5 differs from the listing's."""
+        if not file_info.get("md5") or md5_digest.hexdigest() == file_info["md5"]:
+            return
+
+        os.remove(tmp_file)
+        journal.drop_transfer(filepath)
+        raise ChecksumMismatch(f"{file_info['filename']} doesn't match its checksum")
+
+    def _request_headers(self, url: str) -> dict:
+        """Headers GoFile expects on a file download."""
+        user_agent = os.getenv("GF_USERAGENT")
+        return {
+            "Cookie": f"accountToken={self._token}",
+            "Accept-Encoding": "gzip, deflate, br",
+            "User-Agent": user_agent if user_agent else "Mozilla/5.0",
+            "Accept": "*/*",
+            "Referer": f"{url}{('/' if not url.endswith('/') else '')}",
+            "Origin": url,
+            "Connection": "keep-alive",
+            "Sec-Fetch-Dest": "empty",
+            "Sec-Fetch-Mode": "cors",
+            "Sec-Fetch-Site": "same-site",
+            "Pragma": "no-cache",
+            "Cache-Control": "no-cache"
+        }
+
+    def _extract_content(self, file_info: dict, kind: str, directory: str, progress: FileProgress) -> None:
+        """Unpack an archive into directory as it downloads, checking the md5 of the bytes that went through."""
+        part_dir = f"{directory}.part"
+        url = file_info["link"]
+
+        progress.done = 0
+        progress.counter = None
+        progress.finished = False
+        progress.total = file_info.get("size") or 0
+        md5_digest = md5()
+
+        try:
+            started = time.monotonic()
+            with get_requests_session().get(url, headers=self._request_headers(url), stream=True, timeout=(9, 27)) as response_handler:
+                time_to_first_byte.observe(time.monotonic() - started, host=host_of(url))
+                if response_handler.status_code != 200:
+                    # Nothing to extract, and what an earlier attempt unpacked would never be finished
+                    rmtree(part_dir, ignore_errors=True)
+                    raise requests.HTTPError(
+                        f"Couldn't download {file_info['filename']}, status code {response_handler.status_code}",
+                        response=response_handler
+                    )
+
+                # An interrupted extraction isn't resumable, it starts over in the same .part directory
+                os.makedirs(part_dir, exist_ok=True)
+                sizer = ChunkSizer()
+                extractor = ArchiveExtractor(part_dir, kind, (md5_digest,))
+                try:
+                    for chunk in read_chunks(response_handler, sizer):
+                        if self._throttle:
+                            self._throttle.consume(len(chunk))
+                        extractor.write([chunk])
+                        progress.done += len(chunk)
+                        sizer.update(len(chunk))
+                except BaseException:
+                    extractor.abort()
+                    raise
+                extractor.close()
+        finally:
+            progress.finished = True
+
+        if file_info.get("md5") and md5_digest.hexdigest() != file_info["md5"]:
+            rmtree(part_dir)
+            raise ChecksumMismatch(f"{file_info['filename']} doesn't match its checksum")
+
+        with self._lock:
+            _print(f"Extracting {file_info['filename']}: Done!{NEW_LINE}")
+            os.replace(part_dir, directory)
+
+    def _fetch_content(self, file_info: dict, filepath: str, progress: FileProgress) -> None:
+        """Requests the contents of the file and writes it."""
+        tmp_file = f"{filepath}.part"
+        url = file_info["link"]
+        headers = self._request_headers(url)
+
+        # A journaled segmented .part is preallocated, so its size says nothing about progress
+        transfer = journal.get_transfer(filepath)
+        segmented_resume = bool(transfer and transfer["segments"] is not None and os.path.isfile(tmp_file))
+
+        # Check for partial download and resume from last byte
+        part_size = 0
+        if os.path.isfile(tmp_file) and not segmented_resume:
+            part_size = int(os.path.getsize(tmp_file))
+            headers["Range"] = f"bytes={part_size}-"
+            if if_range_value(transfer):
+                headers["If-Range"] = if_range_value(transfer)
+
+        progress.done = part_size
+        progress.counter = None
+        progress.finished = False
+        md5_digest = md5()
+
+        # Large files on range-capable hosts are fetched over several connections
+        if part_size == 0:
+            if segmented_resume:
+                size, response_headers = transfer["size"], None
+            else:
+                size, response_headers = SegmentedDownloader.probe(url, headers)
+
+            if size and (segmented_resume or size >= SEGMENT_MIN_SIZE):
+                progress.total = size
+                if segmented_transfer(url, headers, filepath, tmp_file, size, response_headers, progress, self._throttle):
+                    progress.finished = True
+                    # Segments arrive out of order, so this is the one path that hashes from disk
+                    digest = hash_file(tmp_file, sha256(), md5_digest)
+                    self._verify(file_info, md5_digest, filepath, tmp_file)
+                    with self._lock:
+                        _print(f"Downloading {file_info['filename']}: {size} of {size} Done!{NEW_LINE}")
+                        move(tmp_file, filepath)
+                    journal.drop_transfer(filepath)
+                    content_index.store(filepath, digest)
+                    return
+
+                # A preallocated file can't be resumed by the single stream below
+                progress.counter = None
+                progress.done = 0
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+                journal.drop_transfer(filepath)
+
+        has_size = None
+        status_code = None
+        digest = sha256()
+
+        try:
+            started = time.monotonic()
+            with get_requests_session().get(url, headers=headers, stream=True, timeout=(9, 27)) as response_handler:
+                time_to_first_byte.observe(time.monotonic() - started, host=host_of(url))
+                status_code = response_handler.status_code
+
+                # A full response to a ranged request means the file changed (If-Range) or
+                # the server ignored the range, either way the partial is useless
+                if part_size > 0 and response_handler.status_code == 200:
+                    _print(f"{file_info['filename']} can't be resumed, starting over.{NEW_LINE}")
+                    part_size = 0
+                    progress.done = 0
+
+                if ((response_handler.status_code in (403, 404, 405, 500)) or
+                    (part_size == 0 and response_handler.status_code != 200) or
+                    (part_size > 0 and response_handler.status_code != 206)):
+                    raise requests.HTTPError(
+                        f"Couldn't download {file_info['filename']}, status code {status_code}",
+                        response=response_handler
+                    )
+
+                content_length = response_handler.headers.get("Content-Length")
+                content_range = response_handler.headers.get("Content-Range")
+                has_size = content_length if part_size == 0 \
+                    else content_range.split("/")[-1] if content_range else None
+
+                # Without a size there is no telling whether the file arrived whole
+                if not has_size:
+                    raise requests.HTTPError(
+                        f"Couldn't find the size of {file_info['filename']}, status code {status_code}",
+                        response=response_handler
+                    )
+
+                progress.total = int(has_size)
+
+                # A resumed file only needs its existing prefix hashed once
+                if part_size > 0:
+                    hash_file(tmp_file, digest, md5_digest)
+                else:
+                    journal.save_transfer(filepath, url, int(has_size), response_handler.headers)
+
+                # Only a counter update per chunk, the tracker computes rates on its own timer
+                sizer = ChunkSizer()
+                writer = FileWriter(tmp_file, part_size, int(has_size), (digest, md5_digest))
+                try:
+                    for chunk in read_chunks(response_handler, sizer):
+                        if self._throttle:
+                            self._throttle.consume(len(chunk))
+                        writer.write([chunk])
+                        progress.done += len(chunk)
+                        sizer.update(len(chunk))
+                finally:
+                    writer.close()
+        finally:
+            progress.finished = True
+            complete = bool(has_size) and file_size(tmp_file) == int(has_size)
+
+        if not complete:
+            # The .part is kept, so running the job again continues it
+            raise requests.exceptions.ChunkedEncodingError(
+                f"{file_info['filename']} ended after {file_size(tmp_file)} of {has_size} bytes"
+            )
+
+        # The hashes were fed as the data streamed through, so checking costs no second read
+        self._verify(file_info, md5_digest, filepath, tmp_file)
+        with self._lock:
+            _print(f"Downloading {file_info['filename']}: "
+                f"{has_size} of {has_size} Done!"
+                f"{NEW_LINE}"
+            )
+            move(tmp_file, filepath)
+        journal.drop_transfer(filepath)
+        content_index.store(filepath, digest.hexdigest())
+
+    def _unique_path(self, path: str, is_file: bool) -> str:
+        """Suffix paths already used by this job with (n), keeping file extensions."""
+        count = self._pathing_count.get(path, -1) + 1
+        self._pathing_count[path] = count
+
+        if count == 0:
+            return path
+
+        if is_file:
+            root, extension = os.path.splitext(path)
+            return f"{root}({count}){extension}"
+
+        return f"{path}({count})"
+
+    def _add_file(self, directory: str, data: dict) -> dict:
+        """Register a listed file to download into directory, keeping its size and md5 to check against."""
+        filepath = self._unique_path(os.path.join(directory, data["name"]), is_file=True)
+        self._files_index += 1
+        file_info = {
+            "path": directory,
+            "filename": os.path.basename(filepath),
+            "link": data["link"],
+            "size": data.get("size"),
+            "md5": data.get("md5")
+        }
+        self._files_info[str(self._files_index)] = file_info
+        return file_info
+
+    def _ensure_content_dir(self, content_id: str) -> str:
+        """Create the job's root directory under the output directory, on the best volume when it is one of them."""
+        if not self._content_dir:
+            # A share fetched before stays on its volume, so a restarted job finds the files it already has
+            previous = [
+                path for path in (os.path.join(root, content_id) for root in volumes.candidates(self._root_dir))
+                if os.path.isdir(path)
+            ]
+            if previous:
+                self._content_dir = previous[0]
+            else:
+                # The share's total size isn't known until it's crawled, so its files are admitted one by one
+                with volumes.reserve(self._root_dir, None, spread=True) as reservation:
+                    self._content_dir = os.path.join(reservation.directory, content_id)
+            self._create_dir(self._content_dir)
+        return self._content_dir
+
+    def _fetch_listing(self, content_id: str, password: str | None = None) -> dict | None:
+        """Get a folder or file listing from the GoFile API, served from cache when fresh."""
+        with _listing_cache_lock:
+            cached = _listing_cache.get((content_id, password))
+        if cached:
+            return cached
+
+        url = f"{GOFILE_API_URL}/contents/{content_id}?wt=4fd6sg89d7s6&cache=true&sortField=createTime&sortDirection=1"
+
+        if password:
+            url = f"{url}&password={password}"
+
+        user_agent = os.getenv("GF_USERAGENT")
+
+        headers = {
+            "User-Agent": user_agent if user_agent else "Mozilla/5.0",
+            "Accept-Encoding": "gzip, deflate, br",
+            "Accept": "*/*",
+            "Connection": "keep-alive",
+            "Authorization": f"Bearer {self._token}",
+        }
+
+        started = time.monotonic()
+        response_handler = get_requests_session().get(url, headers=headers, timeout=(9, 27))
+        gofile_api_latency.observe(time.monotonic() - started, endpoint="contents")
+
+        # The cached guest account may have been removed, get a new one and retry once
+        if response_handler.status_code == 401 and not self._fixed_token:
+            with self._lock:
+                self._token = self._get_token(refresh=True)
+            headers["Authorization"] = f"Bearer {self._token}"
+            started = time.monotonic()
+            response_handler = get_requests_session().get(url, headers=headers, timeout=(9, 27))
+            gofile_api_latency.observe(time.monotonic() - started, endpoint="contents")
+
+        response = response_handler.json()
+
+        if response["status"] != "ok":
+            _print(f"Failed to get a link as response from the {url}.{NEW_LINE}")
+            return None
+
+        data = response["data"]
+
+        if "password" in data and "passwordStatus" in data and data["passwordStatus"] != "passwordOk":
+            _print(f"Password protected link. Please provide the password.{NEW_LINE}")
+            return None
+
+        with _listing_cache_lock:
+            _listing_cache[(content_id, password)] = data
+
+        return data
+
+    def _handle_listing(self, content_id: str, data: dict, parent_dir: str | None) -> tuple[list, list]:
+        """Create the listed folder and return its (subfolders, files) to crawl and download."""
+        if data["type"] != "folder":
+            # A link to a single file still gets its own content directory
+            directory = parent_dir if parent_dir else self._ensure_content_dir(content_id)
+            return [], [self._add_file(directory, data)]
+
+        folder_name = data["name"]
+
+        if parent_dir:
+            folder_dir = self._unique_path(os.path.join(parent_dir, folder_name), is_file=False)
+        elif folder_name == content_id:
+            # Do not nest a folder named after the id inside the content directory
+            folder_dir = self._ensure_content_dir(content_id)
+        else:
+            folder_dir = self._unique_path(
+                os.path.join(self._ensure_content_dir(content_id), folder_name), is_file=False
+            )
+
+        self._create_dir(folder_dir)
+
+        subfolders = []
+        files = []
+        for child_id in data["children"]:
+            child = data["children"][child_id]
+
+            if child["type"] == "folder":
+                subfolders.append((child["id"], folder_dir))
+            else:
+                files.append(self._add_file(folder_dir, child))
+
+        return subfolders, files
+
+    def download(self, url: str, password: str | None = None) -> dict:
+        """Main function to start the download process."""
+        try:
+            if not url.split("/")[-2] == "d":
+                return {"status": "error", "message": f"The url probably doesn't have an id in it: {url}"}
+
+            content_id = url.split("/")[-1]
+        except IndexError:
+            return {"status": "error", "message": f"{url} doesn't seem a valid url."}
+
+        _password = sha256(password.encode()).hexdigest() if password else password
+
+        self.progress.start()
+        try:
+            self._crawl_and_download(content_id, _password)
+        finally:
+            self.progress.stop()
+
+        # Probably the link is broken so the content dir wasn't even created
+        if not self._content_dir:
+            return {"status": "error", "message": f"No content directory created for url: {url}, nothing done."}
+
+        # Removes the root content directory if there's no file or subdirectory
+        if not os.listdir(self._content_dir) and not self._files_info:
+            os.rmdir(self._content_dir)
+            return {"status": "error", "message": f"Empty directory for url: {url}, nothing done."}
+        
+        # Files that failed (out of space, bad checksum, ...) make the result partial, or an error if none came through
+        downloaded = [
+            file_info for file_info in self._files_info.values()
+            if os.path.join(file_info["path"], file_info["filename"]) not in self._failed
+        ]
+        if self._failed and not downloaded:
+            status = "error"
+        elif self._failed:
+            status = "partial"
+        else:
+            status = "success"
+
+        # Return the result with downloaded files
+        result = {
+            "status": status,
+            "content_dir": self._content_dir,
+            "files": downloaded,
+            "failed": self._failed,
+        }
+        if status == "error":
+            result["message"] = f"None of the {len(self._failed)} files could be downloaded"
+        
+        return result
+
+# Async HTTP download engine
+_http_session: aiohttp.ClientSession | None = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Return the shared aiohttp session, creating it on first use."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=300
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=9, sock_read=27)
+        )
+    return _http_session
+
+async def close_http_session(application: Application | None = None) -> None:
+    """Close the shared aiohttp session on shutdown."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+def filename_from_response(url: str, headers) -> str:
+    """Extract filename from content-disposition header or fall back to the URL."""
+    filename = None
+    content_disposition = headers.get("content-disposition")
+    if content_disposition and "filename=" in content_disposition:
+        filename = content_disposition.split("filename=")[1].split(";")[0].strip('"')
+
+    if not filename:
+        filename = url.split("?")[0].rstrip("/").split("/")[-1] or "downloaded_file"
+
+    # Never let the remote side pick a path outside the output directory
+    return os.path.basename(filename) or "downloaded_file"
+
+def file_size(path: str) -> int:
+    """Size of path, 0 when it doesn't exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def discard_download(path: str) -> None:
+    """Remove what a failed download left under path: its .part, its journal entry and the name it claimed."""
+    if os.path.isdir(path):
+        rmtree(path, ignore_errors=True)
+        return
+
+    if os.path.exists(f"{path}.part"):
+        os.remove(f"{path}.part")
+    journal.drop_transfer(path)
+    # Only the empty placeholder from reserve_filepath, never a finished file
+    if os.path.isfile(path) and not os.path.getsize(path):
+        os.remove(path)
+
+def abandon_job(job_id: int | None) -> None:
+    """End a job that failed for good, removing what its download left behind so nothing resumes it."""
+    target = journal.job_target(job_id) if job_id is not None else None
+    if target:
+        discard_download(target)
+    journal.finish_job(job_id)
+
+async def stream_body(response: aiohttp.ClientResponse, writer, throttle: Throttle | None = None) -> None:
+    """Hand a response body to writer (a FileWriter or ArchiveExtractor) as it arrives."""
+    sizer = ChunkSizer()
+    batch, batched = [], 0
+    while chunk := await response.content.read(sizer.size):
+        if throttle:
+            await throttle.wait(len(chunk))
+        # aiohttp hands over whatever has arrived, so small reads are batched into one pwritev
+        batch.append(chunk)
+        batched += len(chunk)
+        if batched >= sizer.size:
+            await writer.write_async(batch)
+            sizer.update(batched)
+            batch, batched = [], 0
+    if batch:
+        await writer.write_async(batch)
+
+async def stream_download(url: str, output_dir: str, headers: dict | None = None, job_id: int | None = None,
+                          target: str | None = None, throttle: Throttle | None = None, extract: bool = False) -> str:
+    """
+    Stream url into output_dir (resuming target's .part if journaled) without blocking the event loop.
+    With extract, an archive is unpacked into a directory as it arrives instead, and that is returned.
+    """
+    session = get_http_session()
+    request_headers = dict(headers or {})
+    # Byte offsets of a resumed .part only line up if the server sends the raw bytes
+    request_headers["Accept-Encoding"] = "identity"
+
+    part_size = 0
+    if target:
+        transfer = await asyncio.to_thread(journal.get_transfer, target)
+        part_size = await asyncio.to_thread(file_size, f"{target}.part")
+        if part_size and if_range_value(transfer):
+            request_headers["Range"] = f"bytes={part_size}-"
+            request_headers["If-Range"] = if_range_value(transfer)
+        else:
+            part_size = 0
+
+    started = time.monotonic()
+    async with session.get(url, headers=request_headers) as response:
+        time_to_first_byte.observe(time.monotonic() - started, host=host_of(url))
+        response.raise_for_status()
+
+        # If-Range answers with the whole file when it changed since the partial was written
+        if part_size and response.status != 206:
+            logger.info(f"{url} changed since the partial download, starting over")
+            part_size = 0
+
+        # Nothing is written unless the rest of the file fits, a new download goes to the best volume for it
+        reservation = await asyncio.to_thread(
+            volumes.reserve, os.path.dirname(target) if target else output_dir, response.content_length, not target
+        )
+        with reservation:
+            filename = filename_from_response(url, response.headers)
+            kind = archive_format(filename) if extract else None
+            if kind:
+                if throttle:
+                    throttle.total = response.content_length
+                # An interrupted extraction starts over in the same directory, overwriting what it had unpacked
+                directory = target
+                if not directory:
+                    directory = await asyncio.to_thread(reserve_dirpath, reservation.directory, archive_stem(filename))
+                    await asyncio.to_thread(journal.set_job_target, job_id, directory)
+                try:
+                    await asyncio.to_thread(reservation.track, directory)
+                    extractor = await asyncio.to_thread(ArchiveExtractor, directory, kind)
+                    try:
+                        await stream_body(response, extractor, throttle)
+                    except BaseException:
+                        await asyncio.to_thread(extractor.abort)
+                        raise
+                    await asyncio.to_thread(extractor.close)
+                except Exception:
+                    if not target and job_id is None:
+                        await asyncio.to_thread(discard_download, directory)
+                    raise
+                return directory
+
+            filepath = target
+            if not filepath:
+                filepath = await asyncio.to_thread(reserve_filepath, reservation.directory, filename)
+                await asyncio.to_thread(journal.set_job_target, job_id, filepath)
+
+            part_file = f"{filepath}.part"
+            try:
+                await asyncio.to_thread(reservation.track, part_file)
+                digest = sha256()
+                if part_size:
+                    await asyncio.to_thread(hash_file, part_file, digest)
+                else:
+                    await asyncio.to_thread(journal.save_transfer, filepath, url, response.content_length, response.headers)
+
+                size = part_size + response.content_length if response.content_length is not None else None
+                if throttle:
+                    throttle.total = response.content_length
+                writer = await asyncio.to_thread(FileWriter, part_file, part_size, size, (digest,))
+                try:
+                    await stream_body(response, writer, throttle)
+                finally:
+                    await asyncio.to_thread(writer.close)
+            except Exception:
+                # A name claimed by this call would otherwise be left behind as an empty file. A journaled
+                # job keeps it for a retry to continue, and whoever ends the job removes it
+                if not target and job_id is None:
+                    await asyncio.to_thread(discard_download, filepath)
+                raise
+
+    await asyncio.to_thread(os.replace, part_file, filepath)
+    await asyncio.to_thread(journal.drop_transfer, filepath)
+    return await asyncio.to_thread(content_index.store, filepath, digest.hexdigest())
+
+DOWNLOAD_INTERRUPTIONS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+async def download_url(url: str, output_dir: str, headers: dict | None = None, job_id: int | None = None,
+                       target: str | None = None, throttle: Throttle | None = None, extract: bool = False) -> str:
+    """
+    Download url using parallel byte ranges when possible, else a single stream, continuing target if journaled.
+    With extract, archives are unpacked as they stream in and the directory they went to is returned.
+    A journaled job cut off by the network is retried up to DOWNLOAD_RETRIES times, continuing where it stopped.
+    """
+    for attempt in itertools.count(1):
+        try:
+            return await _download_url(url, output_dir, headers, job_id, target, throttle, extract)
+        except DOWNLOAD_INTERRUPTIONS as e:
+            if job_id is None or attempt > DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f"Download of {url} interrupted (attempt {attempt}/{DOWNLOAD_RETRIES}), continuing: {e}")
+            # The target the interrupted attempt picked is in the journal, along with its .part
+            target = await asyncio.to_thread(journal.job_target, job_id) or target
+            await asyncio.sleep(DOWNLOAD_BACKOFF * 2 ** (attempt - 1))
+
+async def _download_url(url: str, output_dir: str, headers: dict | None, job_id: int | None,
+                        target: str | None, throttle: Throttle | None, extract: bool) -> str:
+    transfer = await asyncio.to_thread(journal.get_transfer, target) if target else None
+
+    if transfer and transfer["segments"] is not None:
+        size, response_headers = transfer["size"], None
+    elif target and await asyncio.to_thread(file_size, f"{target}.part"):
+        # A single stream .part is continued by stream_download
+        size, response_headers = None, None
+    else:
+        size, response_headers = await asyncio.to_thread(SegmentedDownloader.probe, url, headers)
+        if not size or size < SEGMENT_MIN_SIZE:
+            size = None
+        # Extraction needs the bytes in order, which out of order segments can't give it
+        if extract and archive_format(filename_from_response(url, response_headers)):
+            size = None
+
+    claimed = None
+    if size:
+        # A resumed segmented transfer already has its whole size preallocated
+        resumed = bool(transfer and transfer["segments"] is not None)
+        reservation = await asyncio.to_thread(
+            volumes.reserve, os.path.dirname(target) if target else output_dir, 0 if resumed else size, not target
+        )
+        with reservation:
+            filepath = target
+            if not filepath:
+                filepath = claimed = await asyncio.to_thread(
+                    reserve_filepath, reservation.directory, filename_from_response(url, response_headers)
+                )
+                await asyncio.to_thread(journal.set_job_target, job_id, filepath)
+
+            part_file = f"{filepath}.part"
+            try:
+                await asyncio.to_thread(reservation.track, part_file)
+                if throttle:
+                    throttle.total = size
+                completed = await asyncio.to_thread(
+                    segmented_transfer, url, headers, filepath, part_file, size, response_headers, None, throttle
+                )
+            except Exception:
+                if claimed and job_id is None:
+                    await asyncio.to_thread(discard_download, claimed)
+                raise
+
+            if completed:
+                await asyncio.to_thread(os.replace, part_file, filepath)
+                await asyncio.to_thread(journal.drop_transfer, filepath)
+                # Segments arrive out of order, so this is the one path that hashes from disk
+                digest = await asyncio.to_thread(hash_file, filepath)
+                return await asyncio.to_thread(content_index.store, filepath, digest)
+
+            # A preallocated .part can't be continued by a single stream
+            if await asyncio.to_thread(file_size, part_file):
+                await asyncio.to_thread(os.remove, part_file)
+            await asyncio.to_thread(journal.drop_transfer, filepath)
+        logger.warning(f"Segmented download of {url} incomplete, retrying as a single stream")
+        target = filepath
+
+    try:
+        return await stream_download(url, output_dir, headers, job_id, target, throttle, extract)
+    except Exception:
+        # The single stream took over the name claimed for the segments, so it doesn't remove it itself
+        if claimed and job_id is None:
+            await asyncio.to_thread(discard_download, claimed)
+        raise
+
+# Download job scheduler
+class DownloadJob:
+    def __init__(self, job_id: int, kind: str, description: str, chat_id: int, host: str, priority: int, factory) -> None:
+        self.job_id = job_id
+        self.kind = kind
+        self.description = description
+        self.chat_id = chat_id
+        self.host = host
+        self.priority = priority
+        self.state = "queued"
+        self.created = time.monotonic()
+        self.started = None
+        self._factory = factory
+        self._future = asyncio.get_running_loop().create_future()
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    async def wait(self):
+        """Wait for the job to finish and return its result (or raise its error)."""
+        return await asyncio.shield(self._future)
+
+    async def wait_done(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for the job to finish, without raising its error; True if it has."""
+        await asyncio.wait([self._future], timeout=timeout)
+        return self.done()
+
+class JobScheduler:
+    """Run download jobs in priority order under global, per-host and per-chat limits."""
+
+    def __init__(self, max_jobs: int, max_per_host: int, max_per_chat: int) -> None:
+        self._max_jobs = max_jobs
+        self._max_per_host = max_per_host
+        self._max_per_chat = max_per_chat
+        self._queue = []
+        self._running = {}
+        self._ids = itertools.count(1)
+        self._seq = itertools.count()
+        # Running job tasks, referenced so they aren't garbage collected mid-download
+        self._tasks = set()
+
+    def submit(self, kind: str, description: str, chat_id: int, host: str, factory, priority: int = PRIORITY_NORMAL) -> DownloadJob:
+        """Queue factory (an async callable) as a job and start it as soon as limits allow."""
+        job = DownloadJob(next(self._ids), kind, description, chat_id, host, priority, factory)
+        heapq.heappush(self._queue, (priority, next(self._seq), job))
+        self._dispatch()
+        return job
+
+    async def run(self, kind: str, description: str, chat_id: int, host: str, factory, priority: int = PRIORITY_NORMAL):
+        """Submit a job and wait for its result."""
+        return await self.submit(kind, description, chat_id, host, factory, priority).wait()
+
+    def queue_position(self, job: DownloadJob) -> int:
+        """1-based position of a queued job, 0 once it is running."""
+        queued = self.snapshot()[1]
+        return queued.index(job) + 1 if job in queued else 0
+
+    def snapshot(self) -> tuple[list[DownloadJob], list[DownloadJob]]:
+        """Return (running, queued) jobs, queued ones in the order they will start."""
+        queued = [job for _, _, job in sorted(self._queue)]
+        return list(self._running.values()), queued
+
+    def _count(self, attribute: str, value) -> int:
+        return sum(1 for job in self._running.values() if getattr(job, attribute) == value)
+
+    def _dispatch(self) -> None:
+        """Start every queued job that fits within the limits, highest priority first."""
+        waiting = []
+        while self._queue and len(self._running) < self._max_jobs:
+            entry = heapq.heappop(self._queue)
+            job = entry[2]
+            if (self._count("host", job.host) >= self._max_per_host or
+                self._count("chat_id", job.chat_id) >= self._max_per_chat):
+                waiting.append(entry)
+                continue
+
+            job.state = "running"
+            job.started = time.monotonic()
+            self._running[job.job_id] = job
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        for entry in waiting:
+            heapq.heappush(self._queue, entry)
+
+    async def _run(self, job: DownloadJob) -> None:
+        try:
+            result = await job._factory()
+            job.state = "done"
+            job._future.set_result(result)
+        except asyncio.CancelledError:
+            # Waiters see the cancellation instead of hanging on a future nobody resolves
+            job.state = "failed"
+            job._future.cancel()
+            raise
+        except BaseException as e:
+            job.state = "failed"
+            job._future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            del self._running[job.job_id]
+            self._dispatch()
+
+scheduler = JobScheduler(MAX_CONCURRENT_JOBS, MAX_JOBS_PER_HOST, MAX_JOBS_PER_CHAT)
+
+def host_of(url: str) -> str:
+    """Hostname used for per-host scheduling limits."""
+    return urlparse(url).hostname or "unknown"
+
+async def run_blocking(function, *args):
+    """Run a long blocking job body on the shared job pool."""
+    return await asyncio.get_running_loop().run_in_executor(_job_executor, function, *args)
+
+# Worker processes
+class WorkerError(Exception):
+    """A job failed inside a worker process."""
+
+class WorkerLost(WorkerError):
+    """The worker running a job went away before finishing it."""
+
+class ProgressReport:
+    """Latest progress of a job, reported the same way whether a worker or this process runs it."""
+
+    def __init__(self) -> None:
+        self.transferred = 0
+        self.total = None
+        self.text = ""
+
+    async def update(self, report: dict) -> None:
+        self.transferred = report["transferred"]
+        self.total = report["total"]
+        self.text = report["text"]
+
+    def format(self) -> str:
+        return self.text
+
+class _WorkerConnection:
+    def __init__(self, writer: asyncio.StreamWriter, pid: int, capacity: int) -> None:
+        self.writer = writer
+        self.pid = pid
+        self.capacity = max(1, capacity)
+        self.jobs = {}
+
+    @property
+    def load(self) -> float:
+        return len(self.jobs) / self.capacity
+
+    async def send(self, message: dict) -> None:
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+
+class WorkerPool:
+    """
+    Front-end side of the broker. Download jobs go to worker processes over a unix socket, to whichever
+    is least loaded, and their progress and results come back as JSON lines. Workers started by hand
+    with "bot.py --worker" join the pool like the ones the bot spawns itself.
+    """
+
+    def __init__(self, socket_path: str, processes: int) -> None:
+        self._socket_path = socket_path
+        self._processes = processes
+        self._workers = []
+        self._connected = asyncio.Event()
+        self._ids = itertools.count(1)
+        self._server = None
+        self._supervisors = []
+        self._spawned = set()
+        self._stopping = False
+        # Runtime /limit changes, replayed to workers that connect later
+        self._limits = {}
+
+    @property
+    def active(self) -> bool:
+        return self._server is not None
+
+    @property
+    def connected(self) -> int:
+        return len(self._workers)
+
+    async def start(self) -> None:
+        """Listen on the broker socket and spawn the configured worker processes."""
+        if not self._processes:
+            return
+        if system() == "Windows":
+            logger.warning("WORKER_PROCESSES needs unix sockets, running downloads in the bot process")
+            return
+
+        os.makedirs(os.path.dirname(self._socket_path) or ".", exist_ok=True)
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        self._server = await asyncio.start_unix_server(self._serve, self._socket_path)
+        self._supervisors = [asyncio.create_task(self._supervise(number)) for number in range(self._processes)]
+        logger.info(f"Broker listening on {self._socket_path}, starting {self._processes} worker processes")
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._supervisors:
+            task.cancel()
+        for process in list(self._spawned):
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _supervise(self, number: int) -> None:
+        """Keep one spawned worker process running, restarting it if it dies."""
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(executable, os.path.abspath(__file__), "--worker")
+            self._spawned.add(process)
+            code = await process.wait()
+            self._spawned.discard(process)
+            if not self._stopping:
+                logger.warning(f"Worker process {number} (pid {process.pid}) exited with {code}, restarting it")
+                await asyncio.sleep(1)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Handle one worker connection until it closes, failing whatever it was still running."""
+        worker = None
+        try:
+            hello = json.loads(await reader.readline())
+            worker = _WorkerConnection(writer, hello["pid"], hello["capacity"])
+            self._workers.append(worker)
+            self._connected.set()
+            logger.info(f"Worker {worker.pid} connected, capacity {worker.capacity}")
+
+            for (direction, scope), rate in self._limits.items():
+                await worker.send({"type": "limit", "direction": direction, "scope": scope, "rate": rate})
+
+            while line := await reader.readline():
+                message = json.loads(line)
+                future, on_progress = worker.jobs.get(message["id"], (None, None))
+                if future is None:
+                    continue
+                if message["type"] == "progress":
+                    if on_progress:
+                        await on_progress(message["progress"])
+                elif message["type"] == "result":
+                    worker.jobs.pop(message["id"])
+                    future.set_result(message["result"])
+                elif message["type"] == "error":
+                    worker.jobs.pop(message["id"])
+                    future.set_exception(WorkerError(message["error"]))
+        except (ValueError, KeyError, ConnectionError) as e:
+            logger.warning(f"Dropping worker connection: {e}")
+        finally:
+            if worker:
+                self._workers.remove(worker)
+                if not self._workers:
+                    self._connected.clear()
+                for future, _ in worker.jobs.values():
+                    if not future.done():
+                        future.set_exception(WorkerLost(f"Worker {worker.pid} exited during the job"))
+                logger.info(f"Worker {worker.pid} disconnected")
+            writer.close()
+
+    async def _pick(self) -> _WorkerConnection:
+        """The least loaded connected worker, waiting up to WORKER_CONNECT_TIMEOUT for one to connect."""
+        if not self._workers:
+            try:
+                await asyncio.wait_for(self._connected.wait(), WORKER_CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise WorkerError("No worker process is connected")
+        return min(self._workers, key=lambda worker: worker.load)
+
+    async def run(self, kind: str, args: dict, on_progress=None):
+        """Run a job on a worker and return its result, once more on another worker if the first one dies."""
+        for attempt in range(1, WORKER_RETRIES + 2):
+            worker = await self._pick()
+            job_id = next(self._ids)
+            future = asyncio.get_running_loop().create_future()
+            worker.jobs[job_id] = (future, on_progress)
+            try:
+                await worker.send({"type": "job", "id": job_id, "kind": kind, "args": args})
+                return await future
+            except (WorkerLost, ConnectionError) as e:
+                worker.jobs.pop(job_id, None)
+                if attempt > WORKER_RETRIES:
+                    raise WorkerLost(str(e))
+                logger.warning(f"{e}, running {kind} job again on another worker")
+                if kind == "download" and args.get("job_id"):
+                    # The lost worker may have picked a target already, continue that one
+                    args = dict(args, target=await asyncio.to_thread(journal.job_target, args["job_id"]))
+
+    async def set_limit(self, direction: str, scope: str, rate: int) -> None:
+        """Pass a /limit change on to every worker, each of which applies it to its own traffic."""
+        self._limits[(direction, scope)] = rate
+        for worker in list(self._workers):
+            try:
+                await worker.send({"type": "limit", "direction": direction, "scope": scope, "rate": rate})
+            except ConnectionError as e:
+                logger.warning(f"Couldn't reach worker {worker.pid}: {e}")
+
+workers = WorkerPool(BROKER_SOCKET, WORKER_PROCESSES)
+
+async def run_worker_job(kind: str, args: dict, report=None):
+    """Body of a /download or /gofile job, run by a worker process or by the bot itself when it has none."""
+    chat_id, url = args["chat_id"], args["url"]
+    throttle = download_shaper.throttle(chat_id, host_of(url), url)
+
+    if kind == "download":
+        progress = None
+        task = asyncio.create_task(
+            download_url(url, args["output_dir"], job_id=args["job_id"], target=args["target"], throttle=throttle,
+                         extract=args["extract"])
+        )
+    else:
+        progress = ProgressTracker()
+        task = asyncio.create_task(run_blocking(
+            lambda: GoFileDownloader(url=None, output_dir=args["output_dir"], progress=progress, throttle=throttle,
+                                     extract=args["extract"]).download(url, args["password"])
+        ))
+    while not task.done():
+        await asyncio.wait([task], timeout=UPDATE_INTERVAL)
+        if report:
+            await report({
+                "transferred": throttle.transferred, "total": throttle.total,
+                "text": progress.format() if progress else "",
+            })
+    return task.result()
+
+async def run_worker(socket_path: str = BROKER_SOCKET) -> None:
+    """Worker process main loop: run jobs from the broker and stream their progress and results back."""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def send(message: dict) -> None:
+        async with write_lock:
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+
+    async def run_job(message: dict) -> None:
+        report = lambda progress: send({"type": "progress", "id": message["id"], "progress": progress})
+        try:
+            result = await run_worker_job(message["kind"], message["args"], report)
+            await send({"type": "result", "id": message["id"], "result": result})
+        except Exception as e:
+            await send({"type": "error", "id": message["id"], "error": str(e)})
+
+    await send({"type": "hello", "pid": os.getpid(), "capacity": MAX_CONCURRENT_JOBS})
+    logger.info(f"Worker {os.getpid()} connected to {socket_path}")
+
+    while line := await reader.readline():
+        message = json.loads(line)
+        if message["type"] == "limit":
+            shaper = download_shaper if message["direction"] == "download" else upload_shaper
+            shaper.set_limit(message["scope"], message["rate"])
+        elif message["type"] == "job":
+            task = asyncio.create_task(run_job(message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    logger.info(f"Broker connection closed, worker {os.getpid()} exiting")
+    await close_http_session()
+    # Download threads can't be interrupted; what they wrote is journaled and resumed by the bot
+    os._exit(0)
+
+# Streaming directory scanner
+class DirectoryScanner:
+    """Walk a directory tree with os.scandir off the event loop, yielding files as soon as they're found."""
+
+    def __init__(self, directory: str, include: list[str] | None = None, exclude: list[str] | None = None,
+                 order: str | None = None) -> None:
+        self._directory = directory
+        self._include = include or []
+        self._exclude = exclude or []
+        # Sorting applies within each directory, so the first files still go out right away
+        self._reverse = bool(order and order.startswith("-"))
+        self._order = order.lstrip("-") if order else None
+        self._stopped = False
+        self.found = 0
+        self.finished = False
+
+    def _matches(self, patterns: list[str], entry: os.DirEntry) -> bool:
+        relative = os.path.relpath(entry.path, self._directory)
+        return any(fnmatch(entry.name, pattern) or fnmatch(relative, pattern) for pattern in patterns)
+
+    def _sort_key(self, entry: os.DirEntry):
+        """Raises OSError when entry went away or can't be read since it was listed."""
+        if self._order == "size":
+            return entry.stat().st_size
+        if self._order == "mtime":
+            return entry.stat().st_mtime
+        return 0
+
+    def walk(self):
+        """Yield matching file paths depth first, without building the whole tree in memory."""
+        pending = [self._directory]
+        while pending and not self._stopped:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    files = []
+                    subdirectories = []
+                    for entry in entries:
+                        if self._exclude and self._matches(self._exclude, entry):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif entry.is_file() and (not self._include or self._matches(self._include, entry)):
+                            # Stat now, so a file that vanishes mid-scan only drops itself, not the scan
+                            try:
+                                files.append((self._sort_key(entry), entry.path))
+                            except OSError as e:
+                                logger.warning(f"Skipping {entry.path}: {e}")
+            except OSError as e:
+                logger.warning(f"Couldn't scan {directory}: {e}")
+                continue
+
+            if self._order in ("size", "mtime"):
+                files.sort(key=lambda file: file[0], reverse=self._reverse)
+
+            for _, path in files:
+                self.found += 1
+                yield path
+
+            # Reversed so the stack visits subdirectories in listing order
+            pending.extend(sorted(subdirectories, reverse=True))
+
+    def _produce(self, loop: asyncio.AbstractEventLoop, found: asyncio.Queue) -> None:
+        try:
+            for path in self.walk():
+                # Blocks while the queue is full, so a slow upload throttles the scan
+                asyncio.run_coroutine_threadsafe(found.put(path), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(found.put(None), loop)
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        found = asyncio.Queue(maxsize=SCAN_QUEUE_SIZE)
+        producer = asyncio.create_task(asyncio.to_thread(self._produce, loop, found))
+        try:
+            while (path := await found.get()) is not None:
+                yield path
+            # A scan that died shouldn't pass for one that found everything
+            await producer
+        finally:
+            self._stopped = True
+            # Unblock a producer still waiting on a full queue
+            while not producer.done():
+                try:
+                    found.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.01)
+            self.finished = True
+            if not producer.cancelled() and producer.exception():
+                logger.error(f"Scan of {self._directory} failed: {producer.exception()}")
+
+# Upload pipeline
+def album_kind(filepath: str, size: int) -> str:
+    """How a file is sent inside an album, judged by its extension and Telegram's photo size limit."""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in PHOTO_EXTENSIONS and size <= ALBUM_PHOTO_MAX:
+        return "photo"
+    if extension in VIDEO_EXTENSIONS:
+        return "video"
+    if extension in AUDIO_EXTENSIONS:
+        return "audio"
+    return "document"
+
+def attachment_file_id(message) -> str | None:
+    attachment = message.effective_attachment
+    # Photos come back as a list of sizes, the last one is the original
+    if isinstance(attachment, (list, tuple)):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, "file_id", None)
+
+class UploadPipeline:
+    """Send files with bounded concurrency, backing off on Telegram flood waits and retrying transient errors."""
+
+    def __init__(self, bot, chat_id: int, state: UploadState, concurrency: int = UPLOAD_CONCURRENCY,
+                 ordered: bool = False, album: bool = False, description: str = "upload") -> None:
+        self._bot = bot
+        self._chat_id = chat_id
+        self._state = state
+        self._album = album
+        self._throttle = upload_shaper.throttle(chat_id, "telegram", description)
+        # Ordered uploads keep a single file in flight so messages arrive in scan order
+        self._max_limit = 1 if ordered else max(1, concurrency)
+        self._limit = self._max_limit
+        self._active = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._slots = asyncio.Condition()
+        self.total = 0
+        self.sent = 0
+        self.reused = 0
+        self.failed = []
+
+    async def run(self, files) -> None:
+        """Upload every path from the async iterable files, stopping early when the chat's UploadState asks to."""
+        pending = asyncio.Queue(maxsize=self._max_limit * 2)
+
+        async def worker() -> None:
+            while (item := await pending.get()) is not None:
+                if not self._state.should_stop:
+                    await self._send_item(item)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self._max_limit)]
+        try:
+            # Closing the iterator stops a directory scan that is still running
+            async with aclosing(aiter(self._albums(files) if self._album else files)) as found:
+                async for item in found:
+                    if self._state.should_stop:
+                        break
+                    self.total += len(item) if isinstance(item, list) else 1
+                    await pending.put(item)
+        finally:
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.gather(*workers)
+
+    async def _send_item(self, item) -> None:
+        """Send one file or album, counting any unexpected error as a failure so the worker stays alive."""
+        try:
+            if isinstance(item, list):
+                await self._send_album(item)
+            else:
+                await self._send(item)
+        except Exception as e:
+            # A dead worker would leave the feeder blocked on a full queue forever
+            logger.exception(f"Unexpected error while uploading {item}")
+            for filepath in [path for path, _ in item] if isinstance(item, list) else [item]:
+                self._fail(filepath, e)
+
+    async def _albums(self, files):
+        """Regroup paths into lists of up to ALBUM_SIZE files that can share an album; others come through alone."""
+        albums = {}
+        async with aclosing(aiter(files)) as found:
+            async for filepath in found:
+                try:
+                    size = await asyncio.to_thread(os.path.getsize, filepath)
+                except OSError:
+                    yield filepath
+                    continue
+                if size > ALBUM_MAX_BYTES:
+                    yield filepath
+                    continue
+
+                kind = album_kind(filepath, size)
+                group = ALBUM_GROUPS[kind]
+                album, album_bytes = albums.pop(group, ([], 0))
+                if album and album_bytes + size > ALBUM_MAX_BYTES:
+                    yield album
+                    album, album_bytes = [], 0
+
+                album.append((filepath, kind))
+                if len(album) == ALBUM_SIZE:
+                    yield album
+                else:
+                    albums[group] = (album, album_bytes + size)
+
+        for album, _ in albums.values():
+            yield album
+
+    async def _acquire(self) -> None:
+        """Wait for a free slot under the current limit and any flood wait in progress."""
+        async with self._slots:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self._active < self._limit:
+                    self._active += 1
+                    return
+                try:
+                    await asyncio.wait_for(self._slots.wait(), timeout=pause if pause > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, flood_wait: float | None = None) -> None:
+        """Free a slot, growing the limit after a run of successes and halving it on a flood wait."""
+        async with self._slots:
+            self._active -= 1
+            if flood_wait is not None:
+                self._paused_until = max(self._paused_until, time.monotonic() + flood_wait)
+                self._limit = max(1, self._limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self._limit and self._limit < self._max_limit:
+                    self._limit += 1
+                    self._successes = 0
+            self._slots.notify_all()
+
+    async def _request(self, description: str, call):
+        """
+        Await call() in a slot, pausing on flood waits and retrying timeouts and network errors with backoff.
+        Returns None if the upload is stopped; rejections and the last transient error are raised.
+        """
+        attempt = 0
+        while not self._state.should_stop:
+            await self._acquire()
+            flood_wait = None
+            try:
+                return await call()
+            except RetryAfter as e:
+                # Flood waits pause every worker and don't count as a failed attempt
+                flood_wait = float(e.retry_after)
+                logger.warning(f"Flood wait of {flood_wait}s while uploading {description}")
+                continue
+            except BadRequest:
+                # A NetworkError subclass, but retrying won't change the answer
+                raise
+            except (TimedOut, NetworkError) as e:
+                attempt += 1
+                logger.warning(f"Upload of {description} failed (attempt {attempt}/{UPLOAD_RETRIES}): {e}")
+                if attempt >= UPLOAD_RETRIES:
+                    raise
+            finally:
+                await self._release(flood_wait)
+
+            await asyncio.sleep(UPLOAD_BACKOFF * 2 ** (attempt - 1))
+        return None
+
+    def _fail(self, filepath: str, error: Exception) -> None:
+        logger.error(f"Failed to upload {filepath}: {error}")
+        self.failed.append(filepath)
 
-                if not has_size:
-                    _print(
-                        f"Couldn't find the file size from {url}."
-                        f"{NEW_LINE}"
-                        f"Status code: {status_code}"
-                        f"{NEW_LINE}"
+    async def _upload_document(self, filepath: str):
+        with open(filepath, 'rb') as f:
+            return await self._bot.send_document(
+                chat_id=self._chat_id,
+                document=f,
+                filename=os.path.basename(filepath)
+            )
+
+    async def _send(self, filepath: str) -> None:
+        try:
+            stat, digest, file_id = await asyncio.to_thread(upload_cache.find, filepath)
+        except OSError as e:
+            self._fail(filepath, e)
+            return
+
+        while True:
+            try:
+                if file_id:
+                    # Already on Telegram's servers, only the reference is sent
+                    message = await self._request(
+                        filepath, partial(self._bot.send_document, chat_id=self._chat_id, document=file_id)
                     )
+                else:
+                    # The Bot API client sends each file as one request body, so it's paced per file
+                    await self._throttle.wait(stat.st_size)
+                    message = await self._request(filepath, partial(self._upload_document, filepath))
+                break
+            except BadRequest as e:
+                if not file_id:
+                    self._fail(filepath, e)
                     return
+                # Telegram no longer accepts the cached file_id, send the bytes instead
+                logger.warning(f"Cached file_id for {filepath} rejected, uploading it again: {e}")
+                await asyncio.to_thread(upload_cache.forget_file_id, file_id)
+                file_id = None
+            except (Forbidden, OSError, NetworkError) as e:
+                self._fail(filepath, e)
+                return
 
-                with open(tmp_file, "ab") as handler:
-                    total_size = float(has_size)
-
-                    start_time = time.perf_counter()
-                    for i, chunk in enumerate(response_handler.iter_content(chunk_size=chunk_size)):
-                        progress = (part_size + (i * len(chunk))) / total_size * 100
-                        
-                        # Update progress for tracking
-                        self._download_progress[file_info["filename"]] = {
-                            "current": part_size + (i * len(chunk)),
-                            "total": int(has_size),
-                            "progress": round(progress, 1)
-                        }
-                        
-                        handler.write(chunk)
-
-                        rate = (i * len(chunk)) / (time.perf_counter()-start_time)
-                        unit = "B/s"
-                        if rate < (1024):
-                            unit = "B/s"
-                        elif rate < (1024*1024):
-                            rate /= 1024
-                            unit = "KB/s"
-                        elif rate < (1024*1024*1024):
-                            rate /= (1024 * 1024)
-                            unit = "MB/s"
-                        elif rate < (1024*1024*1024*1024):
-                            rate /= (1024 * 1024 * 1024)
-                            unit = "GB/s"
-
-                        # Thread safe update the self._message
-                        with self._lock:
-                            _print(f"\r{' ' * len(self._message)}")
-                            self._message = f"\rDownloading {file_info['filename']}: {part_size + i * len(chunk)}" \
-                            f" of {has_size} {round(progress, 1)}% {round(rate, 1)}{unit}"
-                            _print(self._message)
-        finally:
-            with self._lock:
-                if has_size and os.path.getsize(tmp_file) == int(has_size):
-                    _print(f"\r{' ' * len(self._message)}")
-                    _print(f"\rDownloading {file_info['filename']}: "
-                        f"{os.path.getsize(tmp_file)} of {has_size} Done!"
-                        f"{NEW_LINE}"
-                    )
-                    move(tmp_file, filepath)
-
-    def _parse_links_recursively(
-        self,
-        content_id: str,
-        password: str | None = None,
-        pathing_count: dict[str, int] = {},
-        recursive_files_index: dict[str, int] = {"index": 0}
-    ) -> None:
-        """Parses for possible links recursively and populate a list with file's info."""
-        url = f"https://api.gofile.io/contents/{content_id}?wt=4fd6sg89d7s6&cache=true&sortField=createTime&sortDirection=1"
+        if message is None:
+            return
+        if file_id:
+            self.reused += 1
+        elif attachment := attachment_file_id(message):
+            await asyncio.to_thread(upload_cache.add, filepath, stat, digest, attachment)
+        self.sent += 1
 
-        if password:
-            url = f"{url}&password={password}"
+    async def _upload_album(self, entries: list) -> tuple:
+        with ExitStack() as stack:
+            media = [
+                ALBUM_MEDIA[kind](
+                    media=file_id or stack.enter_context(open(filepath, 'rb')),
+                    filename=os.path.basename(filepath)
+                )
+                for filepath, kind, _, _, file_id in entries
+            ]
+            return await self._bot.send_media_group(chat_id=self._chat_id, media=media)
 
-        user_agent = os.getenv("GF_USERAGENT")
+    async def _send_album(self, album: list) -> None:
+        """Send up to ALBUM_SIZE files in one sendMediaGroup call, one by one if Telegram won't take them together."""
+        entries = []
+        for filepath, kind in album:
+            try:
+                entries.append((filepath, kind, *await asyncio.to_thread(upload_cache.find, filepath, kind)))
+            except OSError as e:
+                self._fail(filepath, e)
 
-        headers = {
-            "User-Agent": user_agent if user_agent else "Mozilla/5.0",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept": "*/*",
-            "Connection": "keep-alive",
-            "Authorization": f"Bearer {self._token}",
-        }
+        # Albums need at least two files
+        if len(entries) < 2:
+            for filepath, *_ in entries:
+                await self._send(filepath)
+            return
 
-        response = requests.get(url, headers=headers).json()
+        description = f"an album of {len(entries)} files"
+        await self._throttle.wait(sum(stat.st_size for _, _, stat, _, file_id in entries if not file_id))
+        try:
+            messages = await self._request(description, partial(self._upload_album, entries))
+        except BadRequest as e:
+            logger.warning(f"Telegram rejected {description}, sending them one by one: {e}")
+            for filepath, *_ in entries:
+                await self._send(filepath)
+            return
+        except (Forbidden, OSError, NetworkError) as e:
+            for filepath, *_ in entries:
+                self._fail(filepath, e)
+            return
 
-        if response["status"] != "ok":
-            _print(f"Failed to get a link as response from the {url}.{NEW_LINE}")
+        if messages is None:
             return
+        for (filepath, kind, stat, digest, file_id), message in zip(entries, messages):
+            if file_id:
+                self.reused += 1
+            elif attachment := attachment_file_id(message):
+                await asyncio.to_thread(upload_cache.add, filepath, stat, digest, attachment, kind)
+            self.sent += 1
 
-        data = response["data"]
+def parse_command_args(args: list[str], flags: set[str], options: set[str] = frozenset()) -> tuple[set[str], dict, list[str]]:
+    """Separate known --flags and repeatable --option=value pairs from the remaining command arguments."""
+    found_flags = set()
+    found_options = {}
+    rest = []
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if arg in flags:
+            found_flags.add(arg)
+        elif name in options and value:
+            found_options.setdefault(name, []).append(value)
+        else:
+            rest.append(arg)
+    return found_flags, found_options, rest
 
-        if "password" in data and "passwordStatus" in data and data["passwordStatus"] != "passwordOk":
-            _print(f"Password protected link. Please provide the password.{NEW_LINE}")
-            return
+# Status message edits
+class _StatusEntry:
+    """A status message, the text it shows and the latest text waiting to replace it."""
 
-        if data["type"] != "folder":
-            current_dir = os.getcwd()
-            filename = data["name"]
-            recursive_files_index["index"] += 1
-            filepath = os.path.join(current_dir, filename)
+    def __init__(self, message) -> None:
+        self.message = message
+        self.latest = None
+        self.shown = None
+        self.pending = False
+        # Shown in the chat's combined message instead
+        self.summarized = False
+        self.final = False
+        self.since = 0.0
+        self.touched = time.monotonic()
 
-            if filepath in pathing_count:
-                pathing_count[filepath] += 1
-            else:
-                pathing_count[filepath] = 0
+class _ChatStatus:
+    def __init__(self) -> None:
+        self.entries = {}
+        self.ready = 0.0
+        self.summary = None
+        self.summary_text = None
+        self.summary_done = False
 
-            if pathing_count and pathing_count[filepath] > 0:
-                extension = ""
-                filename, extension = os.path.splitext(filename)
-                filename = f"{filename}({pathing_count[filepath]}){extension}"
+class StatusEdits:
+    """
+    One outbound queue for every status message edit, paced per chat and overall.
 
-            self._files_info[str(recursive_files_index["index"])] = {
-                "path": current_dir,
-                "filename": filename,
-                "link": data["link"]
-            }
+    Only the latest text of a message is kept, so a slow chat skips intermediate progress instead of
+    falling behind, and text a message already shows is never sent again. Final edits go first. When
+    a chat has STATUS_BATCH_THRESHOLD or more jobs reporting progress, their texts are combined into
+    one message of its own, which is removed once they have all finished.
+    """
 
-            return
+    def __init__(self) -> None:
+        self._chats = {}
+        self._next_send = 0.0
+        self._wakeup = None
+        self._task = None
 
-        # Do not use the default root directory named "root"
-        folder_name = data["name"]
+    def _start(self) -> None:
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
 
-        if not self._content_dir and folder_name != content_id:
-            self._content_dir = os.path.join(self._root_dir, content_id)
-            self._create_dir(self._content_dir)
-            os.chdir(self._content_dir)
-        elif not self._content_dir and folder_name == content_id:
-            self._content_dir = os.path.join(self._root_dir, content_id)
-            self._create_dir(self._content_dir)
+    def _entry(self, message) -> _StatusEntry:
+        chat = self._chats.setdefault(message.chat_id, _ChatStatus())
+        entry = chat.entries.get(message.message_id)
+        if entry is None:
+            entry = chat.entries[message.message_id] = _StatusEntry(message)
+        return entry
 
-        # Only create subdirectories after the content directory is already created
-        absolute_path = os.path.join(os.getcwd(), folder_name)
+    def _queue(self, message, text: str, final: bool) -> _StatusEntry:
+        self._start()
+        entry = self._entry(message)
+        entry.touched = time.monotonic()
+        entry.final = entry.final or final
+        if text == entry.latest and (entry.pending or entry.summarized and not final):
+            return entry
 
-        if absolute_path in pathing_count:
-            pathing_count[absolute_path] += 1
-        else:
-            pathing_count[absolute_path] = 0
+        entry.latest = text
+        entry.summarized = False
+        if text == entry.shown:
+            entry.pending = False
+            return entry
 
-        if pathing_count and pathing_count[absolute_path] > 0:
-            absolute_path = f"{absolute_path}({pathing_count[absolute_path]})"
+        if not entry.pending:
+            entry.since = entry.touched
+        entry.pending = True
+        self._wakeup.set()
+        return entry
 
-        self._create_dir(absolute_path)
-        os.chdir(absolute_path)
+    def post(self, message, text: str) -> None:
+        """Show text in message when the chat's budget allows, replacing any edit still waiting for it."""
+        self._queue(message, text, final=False)
 
-        for child_id in data["children"]:
-            child = data["children"][child_id]
+    def finish(self, message, text: str) -> None:
+        """Show a message's last text, ahead of progress edits, and forget the message once it's sent."""
+        entry = self._queue(message, text, final=True)
+        if not entry.pending:
+            self._forget(message.chat_id, entry)
 
-            if child["type"] == "folder":
-                self._parse_links_recursively(child["id"], password, pathing_count, recursive_files_index)
-            else:
-                current_dir = os.getcwd()
-                filename = child["name"]
-                recursive_files_index["index"] += 1
-                filepath = os.path.join(current_dir, filename)
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._chats.clear()
 
-                if filepath in pathing_count:
-                    pathing_count[filepath] += 1
-                else:
-                    pathing_count[filepath] = 0
+    def _forget(self, chat_id: int, entry: _StatusEntry) -> None:
+        chat = self._chats.get(chat_id)
+        if chat and chat.entries.get(entry.message.message_id) is entry:
+            del chat.entries[entry.message.message_id]
+            chat.summary_done = chat.summary is not None and not any(
+                not other.final for other in chat.entries.values()
+            )
+            if chat.summary_done:
+                self._wakeup.set()
 
-                if pathing_count and pathing_count[filepath] > 0:
-                    extension = ""
-                    filename, extension = os.path.splitext(filename)
-                    filename = f"{filename}({pathing_count[filepath]}){extension}"
+    def _prune(self, now: float) -> None:
+        """Forget messages nobody has updated for a long time, whose jobs ended without a final edit."""
+        for chat_id, chat in list(self._chats.items()):
+            for message_id, entry in list(chat.entries.items()):
+                if not entry.pending and now - entry.touched > STATUS_IDLE_TTL:
+                    del chat.entries[message_id]
+            if not chat.entries and not chat.summary:
+                del self._chats[chat_id]
 
-                self._files_info[str(recursive_files_index["index"])] = {
-                    "path": current_dir,
-                    "filename": filename,
-                    "link": child["link"]
-                }
+    def _has_work(self, chat: _ChatStatus) -> bool:
+        return chat.summary_done or any(entry.pending for entry in chat.entries.values())
 
-        os.chdir(os.path.pardir)
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._prune(now)
+            waiting = [(max(chat.ready, self._next_send), chat_id) for chat_id, chat in self._chats.items()
+                       if self._has_work(chat)]
+            if not waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
 
-    def download(self, url: str, password: str | None = None) -> dict:
-        """Main function to start the download process."""
-        try:
-            if not url.split("/")[-2] == "d":
-                return {"status": "error", "message": f"The url probably doesn't have an id in it: {url}"}
+            ready, chat_id = min(waiting)
+            if ready > now:
+                # A new edit may be for a chat that is ready sooner
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), ready - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-            content_id = url.split("/")[-1]
-        except IndexError:
-            return {"status": "error", "message": f"{url} doesn't seem a valid url."}
+            chat = self._chats[chat_id]
+            chat.ready = now + STATUS_CHAT_INTERVAL
+            self._next_send = now + 1 / STATUS_EDITS_PER_SECOND
+            try:
+                await self._send(chat_id, chat)
+            except RetryAfter as e:
+                logger.warning(f"Flood wait of {e.retry_after}s on status messages in chat {chat_id}")
+                chat.ready = time.monotonic() + float(e.retry_after)
+            except Exception as e:
+                logger.warning(f"Couldn't update a status message in chat {chat_id}: {e}")
 
-        _password = sha256(password.encode()).hexdigest() if password else password
+    async def _send(self, chat_id: int, chat: _ChatStatus) -> None:
+        """Make the most useful edit the chat has waiting: a final text, the combined message, else the oldest."""
+        pending = [entry for entry in chat.entries.values() if entry.pending]
+        finals = [entry for entry in pending if entry.final]
+        live = [entry for entry in chat.entries.values() if not entry.final]
 
-        self._parse_links_recursively(content_id, _password)
+        if finals:
+            await self._deliver(chat_id, min(finals, key=lambda entry: entry.since))
+        elif pending and len(live) >= STATUS_BATCH_THRESHOLD:
+            await self._deliver_summary(chat_id, chat, live)
+        elif pending:
+            await self._deliver(chat_id, min(pending, key=lambda entry: entry.since))
+        elif chat.summary_done:
+            summary, chat.summary, chat.summary_text, chat.summary_done = chat.summary, None, None, False
+            try:
+                await summary.delete()
+            except TelegramError as e:
+                logger.debug(f"Couldn't remove the combined status message in chat {chat_id}: {e}")
 
-        # Probably the link is broken so the content dir wasn't even created
-        if not self._content_dir:
-            return {"status": "error", "message": f"No content directory created for url: {url}, nothing done."}
+    async def _deliver(self, chat_id: int, entry: _StatusEntry) -> None:
+        text = entry.latest
+        entry.pending = False
+        try:
+            await entry.message.edit_text(text[:MESSAGE_TEXT_LIMIT])
+            entry.shown = text
+        except RetryAfter:
+            # Unless something newer came in meanwhile, this text is still the one to send
+            if not entry.pending:
+                entry.pending = True
+            raise
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                entry.shown = text
+            else:
+                logger.warning(f"Couldn't update a status message in chat {chat_id}: {e}")
+        except TelegramError as e:
+            # Dropped, the next progress update brings the message up to date
+            logger.warning(f"Couldn't update a status message in chat {chat_id}: {e}")
+        if entry.final and not entry.pending:
+            self._forget(chat_id, entry)
 
-        # Removes the root content directory if there's no file or subdirectory
-        if not os.listdir(self._content_dir) and not self._files_info:
-            os.rmdir(self._content_dir)
-            return {"status": "error", "message": f"Empty directory for url: {url}, nothing done."}
+    async def _deliver_summary(self, chat_id: int, chat: _ChatStatus, live: list[_StatusEntry]) -> None:
+        share = max(MESSAGE_TEXT_LIMIT // (len(live) + 1), 80)
+        parts = [f"📋 {len(live)} jobs in progress"]
+        parts.extend(entry.latest[:share] for entry in sorted(live, key=lambda entry: entry.message.message_id)
+                     if entry.latest)
+        text = "\n\n".join(parts)[:MESSAGE_TEXT_LIMIT]
 
-        self._threaded_downloads()
-        
-        # Return successful result with downloaded files
-        result = {
-            "status": "success", 
-            "content_dir": self._content_dir,
-            "files": list(self._files_info.values())
-        }
-        
-        return result
+        for entry in live:
+            entry.pending = False
+            entry.summarized = True
+        if text == chat.summary_text:
+            return
+
+        try:
+            if chat.summary is None:
+                chat.summary = await live[0].message.get_bot().send_message(chat_id, text)
+            else:
+                await chat.summary.edit_text(text)
+            chat.summary_text = text
+        except RetryAfter:
+            # Whatever wasn't replaced meanwhile still has to be sent
+            for entry in live:
+                if entry.summarized:
+                    entry.summarized = False
+                    entry.pending = True
+            raise
+        chat.summary_done = False
+
+status_edits = StatusEdits()
 
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -374,10 +3735,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 📋 Available commands:
 • /start - Show this help message
 • /setoutputdir <path> - Set download directory
-• /download <url> - Download from various file hosting sites
-• /gofile <url> [password] - Download from GoFile
-• /upload <directory> - Upload files from directory
+• /download [--extract] <url> - Download from various file hosting sites
+• /gofile <url> [password] [--extract] - Download from GoFile
+• /upload [--ordered] [--album] [--sort=size|mtime] [--include=GLOB] [--exclude=GLOB] <directory> - Upload files from directory
 • /stopupload - Stop current upload
+• /queue - Show running and queued downloads
+• /limit [download|upload] [global|chat|job] [rate] - Show or change bandwidth limits
+• /stats - Show throughput, queue and latency statistics
 
 📁 Current download directory: {}
 
@@ -405,54 +3769,272 @@ async def set_output_dir(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(f"Failed to set output directory: {str(e)}")
 
 async def download_from_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Download from various file hosting sites."""
-    if not context.args:
-        await update.message.reply_text("Please provide a download URL.")
+    """Download from various file hosting sites, one URL, several, or a .txt list of them replied to."""
+    flags, _, urls = parse_command_args(context.args, {"--extract"})
+    extract = "--extract" in flags
+    reply = update.message.reply_to_message
+    # Replying to some other file with URLs given downloads just those, only a .txt list adds to them
+    if reply and reply.document and (is_url_list(reply.document) or not urls):
+        try:
+            urls += await read_url_list(context.bot, reply.document)
+        except (ValueError, TelegramError) as e:
+            await update.message.reply_text(f"Couldn't read the URL list: {e}")
+            return
+
+    if not urls:
+        await update.message.reply_text("Please provide a download URL, several of them, or reply to a .txt list.")
         return
     
-    url = context.args[0]
+    chat_id = update.effective_chat.id
+    if len(urls) > 1:
+        await run_batch_download(update.message.reply_text, chat_id, urls, OUTPUT_DIR, extract)
+        return
     
-    # Simple download using requests
+    url = urls[0]
+    job_id = await asyncio.to_thread(journal.begin_job, "download", url, chat_id, OUTPUT_DIR, extract=extract)
+    await run_link_download(update.message.reply_text, chat_id, url, OUTPUT_DIR, job_id, extract=extract)
+
+def submit_link_download(chat_id: int, url: str, output_dir: str, job_id: int | None = None,
+                         target: str | None = None, report=None, extract: bool = False) -> DownloadJob:
+    """Queue a /download job, run by a worker process when there are any, with progress going to report."""
+    args = {"chat_id": chat_id, "url": url, "output_dir": output_dir, "job_id": job_id, "target": target,
+            "extract": extract}
+    return scheduler.submit(
+        "download", url, chat_id, host_of(url),
+        lambda: workers.run("download", args, report) if workers.active else run_worker_job("download", args, report)
+    )
+
+async def run_link_download(send, chat_id: int, url: str, output_dir: str, job_id: int | None = None,
+                            target: str | None = None, extract: bool = False) -> None:
+    """Run a journaled /download job, reporting through send (a reply_text like coroutine)."""
+    # Stream the download through the shared aiohttp session
+    progress_message = None
     try:
-        progress_message = await update.message.reply_text(f"Starting download from: {url}")
-        
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
+        progress_message = await send(f"Starting download from: {url}")
         
-        # Extract filename from URL or content-disposition header
-        filename = None
-        if 'content-disposition' in response.headers:
-            content_disposition = response.headers['content-disposition']
-            if 'filename=' in content_disposition:
-                filename = content_disposition.split('filename=')[1].strip('"')
+        job = submit_link_download(chat_id, url, output_dir, job_id, target, extract=extract)
+        position = scheduler.queue_position(job)
+        if position:
+            status_edits.post(progress_message, f"⏳ Queued at position {position}: {url}")
         
-        if not filename:
-            filename = url.split('/')[-1] or "downloaded_file"
-        
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        try:
+            filepath = await job.wait()
+        except Exception:
+            # Network interruptions were already retried inside the job, so this failure is final
+            await asyncio.to_thread(abandon_job, job_id)
+            raise
+        filename = os.path.basename(filepath)
         
-        file_size = humanize.naturalsize(os.path.getsize(filepath))
-        await progress_message.edit_text(f"✅ Download complete!\nFile: {filename}\nSize: {file_size}\nSaved to: {filepath}")
+        await asyncio.to_thread(journal.finish_job, job_id)
+        size = humanize.naturalsize(await asyncio.to_thread(path_size, filepath))
+        if os.path.isdir(filepath):
+            status_edits.finish(progress_message, f"✅ Download extracted!\nFolder: {filename}\nSize: {size}\nSaved to: {filepath}")
+        else:
+            status_edits.finish(progress_message, f"✅ Download complete!\nFile: {filename}\nSize: {size}\nSaved to: {filepath}")
         
     except Exception as e:
-        await update.message.reply_text(f"Download failed: {str(e)}")
+        await asyncio.to_thread(journal.finish_job, job_id)
+        if progress_message:
+            status_edits.finish(progress_message, f"Download failed: {str(e)}")
+        else:
+            await send(f"Download failed: {str(e)}")
+
+def parse_url_list(text: str) -> list[str]:
+    """URLs of a .txt list, separated by whitespace, skipping blank lines and # comments."""
+    urls = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            urls.extend(line.split())
+    return urls
+
+def is_url_list(document) -> bool:
+    """Whether document is a .txt file, the only kind read as a list of URLs."""
+    return (document.file_name or "").lower().endswith(".txt")
+
+async def read_url_list(bot, document) -> list[str]:
+    """URLs listed in a .txt document, read off disk when the local Bot API server already has it."""
+    if not is_url_list(document):
+        raise ValueError("the list must be a .txt file")
+    if document.file_size and document.file_size > URL_LIST_MAX_BYTES:
+        raise ValueError(f"the list is larger than {humanize.naturalsize(URL_LIST_MAX_BYTES)}")
+
+    file = await bot.get_file(document.file_id)
+    source_path = await asyncio.to_thread(local_bot_api_path, file.file_path)
+    if source_path:
+        data = await asyncio.to_thread(Path(source_path).read_bytes)
+    else:
+        data = await file.download_as_bytearray()
+    return parse_url_list(bytes(data[:URL_LIST_MAX_BYTES]).decode("utf-8", errors="replace"))
+
+def validate_url(url: str) -> str | None:
+    """Why url can't be downloaded, or None when it looks like it can."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        return "not an http(s) URL"
+    if not parsed.hostname:
+        return "no host"
+    return None
+
+class BatchEntry:
+    """One URL of a batch /download and how far it has got."""
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        # pending, invalid, queued, done or failed; queued covers waiting on and running in the scheduler
+        self.state = "pending"
+        self.job = None
+        self.job_id = None
+        self.filepath = None
+        self.size = None
+        self.error = None
+        self.progress = ProgressReport()
+
+    @property
+    def running(self) -> bool:
+        return self.state == "queued" and self.job is not None and self.job.state == "running"
+
+    @property
+    def transferred(self) -> int:
+        return self.size if self.state == "done" else self.progress.transferred
+
+    @property
+    def total(self) -> int | None:
+        return self.size if self.state == "done" else self.progress.total
+
+    def label(self) -> str:
+        if self.filepath:
+            name = os.path.basename(self.filepath)
+        else:
+            parsed = urlparse(self.url)
+            name = f"{parsed.hostname or ''}/{os.path.basename(parsed.path.rstrip('/'))}".strip("/") or self.url
+        return name if len(name) <= 60 else f"{name[:57]}..."
+
+def format_batch(entries: list[BatchEntry], elapsed: float) -> str:
+    """Status text of a batch /download: counts, throughput, ETA and a line per URL, most interesting first."""
+    valid = [entry for entry in entries if entry.state != "invalid"]
+    running = [entry for entry in valid if entry.running]
+    done = sum(entry.state == "done" for entry in valid)
+    failed = sum(entry.state == "failed" for entry in valid)
+    waiting = len(valid) - done - failed - len(running)
+    invalid = len(entries) - len(valid)
+
+    transferred = sum(entry.transferred or 0 for entry in valid)
+    speed = transferred / elapsed if elapsed > 0 else 0
+    # URLs whose size isn't known yet are guessed to be as large as the average of those whose size is
+    known = [entry.total for entry in valid if entry.total]
+    average = sum(known) / len(known) if known else None
+    remaining = 0
+    for entry in valid:
+        if entry.state in ("done", "failed"):
+            continue
+        total = entry.total or average
+        if total is None:
+            remaining = None
+            break
+        remaining += max(total - entry.transferred, 0)
+
+    lines = [f"📦 Batch download: {done}/{len(valid)} done, {len(running)} running, {waiting} waiting, {failed} failed"
+             + (f", {invalid} invalid" if invalid else "")]
+    summary = f"{humanize.naturalsize(transferred)} at {humanize.naturalsize(speed)}/s"
+    if waiting or running:
+        eta = remaining / speed if remaining is not None and speed else None
+        summary += f", ETA {humanize.naturaldelta(eta) if eta is not None else 'unknown'}"
+    lines.append(summary)
+    lines.append("")
+
+    order = {"failed": 1, "invalid": 2, "pending": 3, "queued": 3, "done": 4}
+    shown = sorted(entries, key=lambda entry: 0 if entry.running else order[entry.state])
+    for entry in shown[:BATCH_STATUS_LINES]:
+        if entry.running:
+            of = f" of {humanize.naturalsize(entry.total)}" if entry.total else ""
+            lines.append(f"⬇️ {entry.label()}: {humanize.naturalsize(entry.transferred)}{of}")
+        elif entry.state == "done":
+            lines.append(f"✅ {entry.label()}: {humanize.naturalsize(entry.size)}")
+        elif entry.state in ("failed", "invalid"):
+            lines.append(f"❌ {entry.label()}: {entry.error}")
+        else:
+            lines.append(f"⏳ {entry.label()}")
+    if len(shown) > BATCH_STATUS_LINES:
+        lines.append(f"... and {len(shown) - BATCH_STATUS_LINES} more")
+    return "\n".join(lines)
+
+async def run_batch_download(send, chat_id: int, urls: list[str], output_dir: str, extract: bool = False) -> None:
+    """Download many URLs, BATCH_CONCURRENCY at a time, reporting in one status message edited as they go.
+
+    URLs are validated and journaled one by one as slots free up, so the first starts downloading while the
+    rest of the list is still being looked at.
+    """
+    entries = [BatchEntry(url) for url in urls]
+    started = time.monotonic()
+    status_message = await send(format_batch(entries, 0))
+
+    async def report_status() -> None:
+        while True:
+            await asyncio.sleep(BATCH_STATUS_INTERVAL)
+            status_edits.post(status_message, format_batch(entries, time.monotonic() - started))
+
+    async def download(entry: BatchEntry) -> None:
+        try:
+            entry.job = submit_link_download(
+                chat_id, entry.url, output_dir, entry.job_id, report=entry.progress.update, extract=extract
+            )
+            entry.filepath = await entry.job.wait()
+        except Exception as e:
+            # Network interruptions were already retried inside the job, so this failure is final
+            await asyncio.to_thread(abandon_job, entry.job_id)
+            entry.error = str(e)
+            entry.state = "failed"
+        else:
+            await asyncio.to_thread(journal.finish_job, entry.job_id)
+            entry.size = await asyncio.to_thread(path_size, entry.filepath)
+            entry.state = "done"
+        finally:
+            slots.release()
+
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    seen = set()
+    tasks = []
+    reporter = asyncio.create_task(report_status())
+    try:
+        for entry in entries:
+            entry.error = validate_url(entry.url) or ("duplicate" if entry.url in seen else None)
+            seen.add(entry.url)
+            if entry.error:
+                entry.state = "invalid"
+                continue
+
+            await slots.acquire()
+            entry.job_id = await asyncio.to_thread(
+                journal.begin_job, "download", entry.url, chat_id, output_dir, extract=extract
+            )
+            entry.state = "queued"
+            tasks.append(asyncio.create_task(download(entry)))
+        await asyncio.gather(*tasks)
+    finally:
+        reporter.cancel()
+    status_edits.finish(status_message, format_batch(entries, time.monotonic() - started))
 
 async def upload_from_directory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Upload files from a directory."""
-    if not context.args:
+    flags, options, args = parse_command_args(
+        context.args, {"--ordered", "--album"}, {"--include", "--exclude", "--sort"}
+    )
+    if not args:
         await update.message.reply_text("Please provide a directory path.")
         return
     
-    directory = " ".join(context.args)
+    directory = " ".join(args)
     
     if not os.path.exists(directory):
         await update.message.reply_text("Directory does not exist.")
         return
     
+    order = options.get("--sort", [None])[-1]
+    if order and order.lstrip("-") not in ("size", "mtime"):
+        await update.message.reply_text("--sort must be size, mtime, -size or -mtime.")
+        return
+    
     # Initialize upload state
     chat_id = update.effective_chat.id
     if chat_id not in upload_states:
@@ -468,41 +4050,37 @@ async def upload_from_directory(update: Update, context: ContextTypes.DEFAULT_TY
     upload_state.should_stop = False
     
     try:
-        files = []
-        for root, dirs, filenames in os.walk(directory):
-            for filename in filenames:
-                if upload_state.should_stop:
-                    break
-                files.append(os.path.join(root, filename))
+        # Files are uploaded while the scan is still running
+        scanner = DirectoryScanner(directory, options.get("--include"), options.get("--exclude"), order)
+        progress_message = await update.message.reply_text(f"Scanning {directory} and uploading as files are found...")
+        pipeline = UploadPipeline(
+            context.bot, chat_id, upload_state, ordered="--ordered" in flags, album="--album" in flags,
+            description=directory
+        )
         
-        if not files:
-            await update.message.reply_text("No files found in directory.")
-            return
+        async def report_progress() -> None:
+            while True:
+                await asyncio.sleep(UPLOAD_PROGRESS_INTERVAL)
+                scanned = f"{scanner.found} files" if scanner.finished else f"{scanner.found} files so far"
+                status_edits.post(progress_message, f"Found {scanned}. Uploaded {pipeline.sent}...")
         
-        progress_message = await update.message.reply_text(f"Found {len(files)} files. Starting upload...")
+        reporter = asyncio.create_task(report_progress())
+        try:
+            await pipeline.run(scanner)
+        finally:
+            reporter.cancel()
         
-        for i, filepath in enumerate(files):
-            if upload_state.should_stop:
-                await progress_message.edit_text("Upload cancelled.")
-                break
-            
-            try:
-                with open(filepath, 'rb') as f:
-                    await context.bot.send_document(
-                        chat_id=update.effective_chat.id,
-                        document=f,
-                        filename=os.path.basename(filepath)
-                    )
-                
-                await progress_message.edit_text(f"Uploaded {i+1}/{len(files)} files...")
-                await asyncio.sleep(1)  # Rate limiting
-                
-            except Exception as file_error:
-                logger.error(f"Failed to upload {filepath}: {file_error}")
-                continue
+        if not scanner.found:
+            status_edits.finish(progress_message, "No files found in directory.")
+            return
         
-        if not upload_state.should_stop:
-            await progress_message.edit_text(f"✅ Upload complete! Sent {len(files)} files.")
+        failed = f"\n⚠️ {len(pipeline.failed)} files failed, see the log." if pipeline.failed else ""
+        if pipeline.reused:
+            failed = f"\n♻️ {pipeline.reused} were already on Telegram and sent without re-uploading.{failed}"
+        if upload_state.should_stop:
+            status_edits.finish(progress_message, f"Upload cancelled. Sent {pipeline.sent}/{pipeline.total} files.{failed}")
+        else:
+            status_edits.finish(progress_message, f"✅ Upload complete! Sent {pipeline.sent} files.{failed}")
             
     except Exception as e:
         await update.message.reply_text(f"Upload failed: {str(e)}")
@@ -515,7 +4093,7 @@ async def stop_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
     if chat_id in upload_states and upload_states[chat_id].is_uploading:
         upload_states[chat_id].should_stop = True
-        await update.message.reply_text("Upload will be stopped after current file.")
+        await update.message.reply_text("Upload will be stopped after the files currently sending.")
     else:
         await update.message.reply_text("No upload in progress.")
 
@@ -523,128 +4101,358 @@ async def downloader(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     """Handle document downloads - fixed version based on working private code."""
     document = update.message.document
     
+    # A .txt list sent with /download as its caption is a batch of URLs, not a file to keep
+    caption = (update.message.caption or "").split()
+    if caption[:1] == ["/download"]:
+        try:
+            urls = await read_url_list(context.bot, document)
+        except (ValueError, TelegramError) as e:
+            await update.message.reply_text(f"Couldn't read the URL list: {e}")
+            return
+        if not urls:
+            await update.message.reply_text("The list has no URLs in it.")
+        else:
+            await run_batch_download(
+                update.message.reply_text, update.effective_chat.id, urls, OUTPUT_DIR, "--extract" in caption
+            )
+        return
+    
     # Send initial message
     await update.message.reply_text(f"Downloading!!! \n\n {document.file_name} ")
 
-    # Get file from Telegram
-    file = await context.bot.get_file(document.file_id)
-
     # Ensure output directory exists
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
-    # Create destination path
-    destination = os.path.join(OUTPUT_DIR, document.file_name)
+    file = None
+
+    async def fetch_document() -> str:
+        nonlocal file
+        # Create destination path without overwriting an existing file of the same name
+        destination = await asyncio.to_thread(reserve_filepath, OUTPUT_DIR, document.file_name)
+
+        # A document we already have is linked into place instead of transferred again
+        try:
+            existing = await asyncio.to_thread(content_index.find_telegram, document.file_unique_id)
+            if existing:
+                try:
+                    await asyncio.to_thread(link_file, existing, destination)
+                    return destination
+                except OSError as e:
+                    logger.warning(f"Couldn't hardlink {existing} to {destination}: {e}")
+
+            # Get file from Telegram
+            file = await context.bot.get_file(document.file_id)
+
+            # With a local Bot API server the file is already on disk, only its location differs
+            source_path = await asyncio.to_thread(local_bot_api_path, file.file_path)
+            if source_path:
+                method = await asyncio.to_thread(ingest_file, source_path, destination)
+                logger.info(f"Ingested {source_path} into {destination} by {method}")
+            else:
+                # It's a URL or the server's storage isn't visible here, download it normally
+                await file.download_to_drive(destination)
+        except BaseException:
+            # Neither the placeholder nor a partial file should keep the name
+            if await asyncio.to_thread(os.path.exists, destination):
+                await asyncio.to_thread(os.remove, destination)
+            raise
+
+        # The file never streamed through us, so it is hashed once from disk
+        digest = await asyncio.to_thread(hash_file, destination)
+        await asyncio.to_thread(content_index.add_telegram, document.file_unique_id, digest)
+        return await asyncio.to_thread(content_index.store, destination, digest)
     
     try:
-        # The key fix: Use the same approach as the working private version
-        # When using custom BASE_URL and empty base_file_url, the file is already downloaded locally
-        # and file.file_path points to the local file
-        
-        # Check if the file path looks like a local path or URL
-        if file.file_path.startswith('/') or not file.file_path.startswith('http'):
-            # It's a local path, try to move it directly
-            source_path = file.file_path
-            # Remove TOKEN from path if it exists (like in working version)
-            if TOKEN and TOKEN in source_path:
-                source_path = source_path.replace(TOKEN, '')
-            
-            # Clean up the path
-            source_path = source_path.lstrip('/')
-            
-            # If source_path doesn't start with /, it might be relative to some base directory
-            # Try different approaches to locate the actual file
-            possible_paths = [
-                source_path,
-                f"/{source_path}",
-                f"/tmp/{source_path}",
-                f"/var/tmp/{source_path}",
-                file.file_path
-            ]
-            
-            moved = False
-            for test_path in possible_paths:
-                if os.path.exists(test_path):
-                    move(test_path, destination)
-                    moved = True
-                    break
-            
-            if not moved:
-                # Fallback: download using the file object
-                await file.download_to_drive(destination)
-                
-        else:
-            # It's a URL, download it normally
-            await file.download_to_drive(destination)
+        destination = await scheduler.run(
+            "document", document.file_name, update.effective_chat.id, "telegram",
+            fetch_document, priority=PRIORITY_HIGH
+        )
         
         await update.message.reply_text(
             f">••Done••< \n\n\n ■ File Location: {destination}"
         )
         
     except Exception as e:
-        logger.error(f"Download error details: file_path={file.file_path}, error={str(e)}")
+        logger.error(f"Download error details: file_path={file.file_path if file else None}, error={str(e)}")
         await update.message.reply_text(f"Failed to download file: {str(e)}")
 
 # GoFile downloader command handler
 async def gofile_download(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handle GoFile downloads via the /gofile command.
-    Expected format: /gofile URL [PASSWORD]
+    Expected format: /gofile URL [PASSWORD] [--extract]
     """
-    if not context.args:
+    flags, _, args = parse_command_args(context.args, {"--extract"})
+    if not args:
         await update.message.reply_text("Please provide a GoFile URL (and optionally a password).")
         return
     
-    url = context.args[0]
-    password = context.args[1] if len(context.args) > 1 else None
+    url = args[0]
+    password = args[1] if len(args) > 1 else None
+    extract = "--extract" in flags
     
+    chat_id = update.effective_chat.id
+    
+    job_id = await asyncio.to_thread(journal.begin_job, "gofile", url, chat_id, OUTPUT_DIR, password, extract)
+    await run_gofile_download(update.message.reply_text, chat_id, url, password, OUTPUT_DIR, job_id, extract)
+
+def format_failures(failed: dict[str, str]) -> str:
+    """One line per file of a /gofile job that failed, up to BATCH_STATUS_LINES of them."""
+    lines = [f"❌ {os.path.basename(filepath)}: {error}" for filepath, error in list(failed.items())[:BATCH_STATUS_LINES]]
+    if len(failed) > BATCH_STATUS_LINES:
+        lines.append(f"... and {len(failed) - BATCH_STATUS_LINES} more")
+    return "\n".join(lines)
+
+async def run_gofile_download(send, chat_id: int, url: str, password: str | None, output_dir: str,
+                              job_id: int | None = None, extract: bool = False) -> None:
+    """Run a journaled /gofile job, reporting through send (a reply_text like coroutine)."""
     # Send initial message
-    progress_message = await update.message.reply_text(f"Starting download from GoFile: {url}")
+    progress_message = await send(f"Starting download from GoFile: {url}")
     
-    # Run the GoFile downloader in a separate thread to avoid blocking the bot
+    # Run the GoFile downloader on a worker process, or the shared job pool, to avoid blocking the bot
     try:
-        # Create a new executor for this task
-        with ThreadPoolExecutor() as executor:
-            # Run the download in a separate thread
-            download_future = executor.submit(
-                lambda: GoFileDownloader(url=None, output_dir=OUTPUT_DIR).download(url, password)
-            )
-            
-            # Check progress and update message periodically
-            while not download_future.done():
-                await asyncio.sleep(5)  # Check every 5 seconds
-                
-                # You could add more detailed progress updates here
-                await progress_message.edit_text(f"Downloading from GoFile: {url}...\nThis may take a while.")
+        progress = ProgressReport()
+        args = {"chat_id": chat_id, "url": url, "password": password, "output_dir": output_dir, "extract": extract}
+        job = scheduler.submit(
+            "gofile", url, chat_id, host_of(url),
+            lambda: workers.run("gofile", args, progress.update) if workers.active
+                else run_worker_job("gofile", args, progress.update),
+            priority=PRIORITY_LOW
+        )
+        
+        # Check progress and update message periodically
+        # Wakes up as soon as the job ends instead of sleeping out the interval
+        while not await job.wait_done(GOFILE_PROGRESS_INTERVAL):
+            position = scheduler.queue_position(job)
+            if position:
+                text = f"⏳ Queued at position {position}: {url}"
+            else:
+                text = f"Downloading from GoFile: {url}\n{progress.format()}"
+            status_edits.post(progress_message, text)
+        
+        # Get the result
+        result = await job.wait()
+        await asyncio.to_thread(journal.finish_job, job_id)
+        
+        if result["status"] == "success":
+            downloaded_files = len(result["files"])
+            content_dir = result["content_dir"]
             
-            # Get the result
-            result = download_future.result()
+            status_edits.finish(
+                progress_message, f"✅ Download complete!\nDownloaded {downloaded_files} files\nLocation: {content_dir}"
+            )
+        elif result["status"] == "partial":
+            status_edits.finish(
+                progress_message,
+                f"⚠️ Download incomplete!\nDownloaded {len(result['files'])} files, {len(result['failed'])} failed\n"
+                f"Location: {result['content_dir']}\n{format_failures(result['failed'])}"
+            )
+        else:
+            text = f"❌ Failed to download: {result['message']}"
+            if result.get("failed"):
+                text = f"{text}\n{format_failures(result['failed'])}"
+            status_edits.finish(progress_message, text)
             
-            if result["status"] == "success":
-                downloaded_files = len(result["files"])
-                content_dir = result["content_dir"]
-                
-                await progress_message.edit_text(
-                    f"✅ Download complete!\nDownloaded {downloaded_files} files\nLocation: {content_dir}"
-                )
-            else:
-                await progress_message.edit_text(f"❌ Failed to download: {result['message']}")
-                
     except Exception as e:
-        await progress_message.edit_text(f"❌ Error downloading from GoFile: {str(e)}")
+        await asyncio.to_thread(journal.finish_job, job_id)
+        status_edits.finish(progress_message, f"❌ Error downloading from GoFile: {str(e)}")
 
-def main() -> None:
-    """Initialize and start the bot with all command handlers."""
-    # Verify that TOKEN is present
-    if not TOKEN:
-        logger.error("No TELEGRAM_TOKEN environment variable set!")
-        exit(1)
+async def show_queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show running and queued download jobs."""
+    running, queued = scheduler.snapshot()
     
-    # Ensure output directory exists
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    if not running and not queued:
+        await update.message.reply_text("No download jobs running or queued.")
+        return
+    
+    now = time.monotonic()
+    lines = [f"▶️ Running ({len(running)}/{MAX_CONCURRENT_JOBS}):"]
+    for job in running:
+        lines.append(f"#{job.job_id} [{job.kind}] {job.description} - {humanize.naturaldelta(now - job.started)}")
+    
+    lines.append(f"\n⏳ Queued ({len(queued)}):")
+    for position, job in enumerate(queued, start=1):
+        lines.append(f"{position}. #{job.job_id} [{job.kind}] {job.description} - waiting {humanize.naturaldelta(now - job.created)}")
+    
+    await update.message.reply_text("\n".join(lines))
+
+async def set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show or change bandwidth limits: /limit [download|upload] [global|chat|job] [rate|off]"""
+    shapers = {"download": download_shaper, "upload": upload_shaper}
+    
+    if not context.args:
+        await update.message.reply_text(f"{download_shaper.describe()}\n{upload_shaper.describe()}")
+        return
+    
+    if len(context.args) != 3 or context.args[0] not in shapers or context.args[1] not in BandwidthShaper.SCOPES:
+        await update.message.reply_text("Usage: /limit [download|upload] [global|chat|job] [rate, e.g. 10M, or off]")
+        return
     
+    direction, scope, value = context.args
+    try:
+        rate = parse_rate(value)
+    except ValueError:
+        await update.message.reply_text(f"Invalid rate: {value}")
+        return
+    
+    shapers[direction].set_limit(scope, rate)
+    await workers.set_limit(direction, scope, rate)
+    await update.message.reply_text(shapers[direction].describe())
+
+def format_latency(histogram: Histogram) -> str:
+    count, mean, p95 = histogram.summary()
+    if not count:
+        return "no requests yet"
+    p95_text = f"p95 ≤ {p95 * 1000:.0f} ms" if p95 is not None else f"p95 > {histogram.buckets[-1]:.0f} s"
+    return f"{count} requests, avg {mean * 1000:.0f} ms, {p95_text}"
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Summarize throughput, queue depth and API latencies; the full set is on the metrics endpoint."""
+    running, queued = scheduler.snapshot()
+    lines = [
+        f"📊 Up {humanize.naturaldelta(time.time() - metrics.started)}",
+        f"Jobs: {len(running)} running, {len(queued)} queued • Threads: {active_count()}",
+        f"⬇️ Downloaded {humanize.naturalsize(transferred_bytes.total(direction='download'))}, "
+        f"⬆️ uploaded {humanize.naturalsize(transferred_bytes.total(direction='upload'))}",
+    ]
+    
+    active = [throttle for shaper in (download_shaper, upload_shaper) for throttle in shaper.throttles()]
+    if active:
+        lines.append("\n🚀 Active transfers:")
+        for throttle in active:
+            lines.append(f"• {throttle.description} - {format_rate(int(throttle.speed()))} avg")
+    
+    lines.append("\n💾 Output volumes:")
+    for directory, free, speed in await asyncio.to_thread(volumes.status, volumes.roots or [OUTPUT_DIR]):
+        written = f", writes at {format_rate(int(speed))}" if speed else ""
+        lines.append(f"• {directory} - {humanize.naturalsize(free)} free{written}")
+    
+    lines.append(f"\n⏱ Time to first byte: {format_latency(time_to_first_byte)}")
+    lines.append(f"📁 GoFile API: {format_latency(gofile_api_latency)}")
+    lines.append(f"🤖 Bot API: {format_latency(telegram_api_latency)}, {telegram_flood_waits.total():.0f} flood waits")
+    
+    await update.message.reply_text("\n".join(lines))
+
+# Tasks started outside of a handler, referenced so they aren't garbage collected
+_background_tasks = set()
+
+async def resume_jobs(application: Application) -> None:
+    """Restart the jobs the journal says were still running when the bot stopped."""
+    for job in await asyncio.to_thread(journal.unfinished_jobs):
+        logger.info(f"Resuming {job['kind']} job {job['id']}: {job['url']}")
+        send = partial(application.bot.send_message, job["chat_id"])
+
+        try:
+            await send(f"♻️ Resuming download interrupted by a restart: {job['url']}")
+        except Exception as e:
+            logger.warning(f"Couldn't notify chat {job['chat_id']} about job {job['id']}: {e}")
+
+        if job["kind"] == "gofile":
+            coroutine = run_gofile_download(
+                send, job["chat_id"], job["url"], job["password"], job["output_dir"], job["id"], bool(job["extract"])
+            )
+        else:
+            coroutine = run_link_download(
+                send, job["chat_id"], job["url"], job["output_dir"], job["id"], job["target"], bool(job["extract"])
+            )
+
+        task = asyncio.create_task(coroutine)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+async def on_startup(application: Application) -> None:
+    await start_metrics_server()
+    await workers.start()
+    await resume_jobs(application)
+
+async def on_shutdown(application: Application) -> None:
+    await status_edits.stop()
+    await workers.stop()
+    await stop_metrics_server()
+    await close_http_session(application)
+
+# Webhook delivery
+async def start_webhook_server(application: Application, host: str, port: int, path: str,
+                               secret: str = "") -> web.AppRunner:
+    """Listen for updates the Bot API server posts to path and hand them straight to the application."""
+
+    async def receive_update(request: web.Request) -> web.Response:
+        # Constant time, so the secret can't be guessed a character at a time from response timings
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if secret and not hmac.compare_digest(received.encode(), secret.encode()):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (ValueError, TypeError, KeyError):
+            return web.Response(status=400)
+
+        # Answered before the handlers run, so a burst of updates is taken in as fast as it arrives
+        await application.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    return runner
+
+async def run_webhook(application: Application, url: str = WEBHOOK_URL, host: str = WEBHOOK_HOST,
+                      port: int = WEBHOOK_PORT, secret: str = WEBHOOK_SECRET, stop: asyncio.Event | None = None) -> None:
+    """Run the bot on webhook delivery until SIGINT/SIGTERM (or stop is set), the counterpart of run_polling."""
+    stop = stop if stop else asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(stop_signal, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # No signal handlers on Windows or outside the main thread
+            pass
+
+    runner = None
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        runner = await start_webhook_server(application, host, port, urlparse(url).path or "/", secret)
+        # Left registered on exit, so the Bot API server holds updates while the bot restarts
+        await application.bot.set_webhook(
+            url, allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS,
+            secret_token=secret if secret else None
+        )
+        logger.info(f"Receiving updates on http://{host}:{port}, registered as {url}")
+        await stop.wait()
+    finally:
+        if runner:
+            await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def build_application(token: str = TOKEN, base_url: str = BASE_URL) -> Application:
+    """Build the bot application with all command handlers registered."""
     # Use the same configuration as your working private version
-    application = Application.builder().token(TOKEN).base_url(BASE_URL).base_file_url("").read_timeout(864000).build()
+    application = (
+        Application.builder()
+        .token(token)
+        .base_url(base_url)
+        .base_file_url("")
+        # Same pool size and timeout the builder would use, timed for the metrics
+        .request(MeteredRequest(connection_pool_size=256, read_timeout=864000))
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -652,15 +4460,44 @@ def main() -> None:
     application.add_handler(CommandHandler("download", download_from_link))
     application.add_handler(CommandHandler("upload", upload_from_directory))
     application.add_handler(CommandHandler("stopupload", stop_upload))
+    application.add_handler(CommandHandler("queue", show_queue))
+    application.add_handler(CommandHandler("limit", set_limit))
+    application.add_handler(CommandHandler("stats", show_stats))
     
     # Add the GoFile downloader command
     application.add_handler(CommandHandler("gofile", gofile_download))
     
     # Message handlers
     application.add_handler(MessageHandler(filters.Document.ALL, downloader))
+    return application
+
+def main() -> None:
+    """Initialize and start the bot with all command handlers, or a worker process with --worker."""
+    if "--worker" in argv[1:]:
+        asyncio.run(run_worker())
+        return
+
+    # Verify that TOKEN is present
+    if not TOKEN:
+        logger.error("No TELEGRAM_TOKEN environment variable set!")
+        exit(1)
+
+    if FSYNC_POLICY not in FSYNC_POLICIES:
+        logger.error(f"FSYNC_POLICY must be one of {', '.join(FSYNC_POLICIES)}")
+        exit(1)
+    
+    # Ensure output directories exist
+    for directory in [OUTPUT_DIR, *OUTPUT_VOLUMES]:
+        os.makedirs(directory, exist_ok=True)
+    
+    application = build_application()
 
     logger.info("Bot starting...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        # Polling also removes a webhook left registered by an earlier run
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
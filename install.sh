@@ -104,6 +104,21 @@ if [ "$INSTALL_LOCAL_API" = true ]; then
     validate_input "API_HASH" "$API_HASH"
 fi
 
+# Webhook delivery (local API server only, it accepts plain HTTP webhooks on any port)
+USE_WEBHOOK=false
+if [ "$INSTALL_LOCAL_API" = true ]; then
+    echo ""
+    echo "📨 Update delivery:"
+    echo "The local API server can push updates to the bot (webhook) instead of the bot polling for them."
+    read -p "Use webhook delivery? (Y/n): " webhook_choice
+    if [[ ! "$webhook_choice" =~ ^[Nn] ]]; then
+        USE_WEBHOOK=true
+        read -p "Enter WEBHOOK_PORT (default: 8443): " WEBHOOK_PORT
+        WEBHOOK_PORT=${WEBHOOK_PORT:-8443}
+        echo "✅ Will use webhook delivery on port $WEBHOOK_PORT"
+    fi
+fi
+
 echo "✅ All inputs collected successfully"
 
 # --- Install Dependencies ---
@@ -223,6 +238,16 @@ BASE_URL=$BASE_URL
 EOF
 fi
 
+if [ "$USE_WEBHOOK" = true ]; then
+    WEBHOOK_SECRET=$(python3 -c 'import secrets; print(secrets.token_hex(32))')
+    cat <<EOF >> .env
+WEBHOOK_URL=http://127.0.0.1:$WEBHOOK_PORT/telegram
+WEBHOOK_HOST=127.0.0.1
+WEBHOOK_PORT=$WEBHOOK_PORT
+WEBHOOK_SECRET=$WEBHOOK_SECRET
+EOF
+fi
+
 echo "✅ Environment file created"
 
 # --- Create systemd Services ---
@@ -341,6 +366,7 @@ if [ "$USE_OFFICIAL_API" = true ]; then
     echo "⚠️  Using official Telegram API (20MB file size limit)"
 elif [ "$INSTALL_LOCAL_API" = true ]; then
     echo "🚀 Using local API server (no file size limits)"
+    [ "$USE_WEBHOOK" = true ] && echo "📨 Updates are delivered by webhook on 127.0.0.1:$WEBHOOK_PORT"
 else
     echo "🌐 Using external API server: $BASE_URL"
 fi